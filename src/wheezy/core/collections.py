@@ -1,6 +1,7 @@
 import struct
 import zlib
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from functools import lru_cache
 from operator import itemgetter
 
 GZIP_HEADER = "\x1f\x8b\x08\x00\x00\x00\x00\x00\x02\xff".encode("latin1")
@@ -253,3 +254,18 @@ def sorted_items(dictionary):
     [('1', 1), ('2', 2)]
     """
     return sorted(dictionary.items(), key=itemgetter(1))
+
+
+@lru_cache(maxsize=256)
+def record_class(names):
+    """Return a record class for a tuple of field *names*. The class
+    is generated once per set of names; records are tuples with no
+    per instance dictionary and attribute access by field name.
+
+    >>> r = record_class(('id', 'name'))._make((1, 'x'))
+    >>> r.id, r.name
+    (1, 'x')
+    >>> record_class(('id', 'name')) is type(r)
+    True
+    """
+    return namedtuple("Record", names, rename=True)
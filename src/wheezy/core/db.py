@@ -1,5 +1,18 @@
+import re
 import warnings
+from asyncio import gather, get_running_loop
+from collections import OrderedDict
+from concurrent.futures import wait
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from heapq import nlargest
+from inspect import isawaitable
+from itertools import islice
+from operator import attrgetter
+from threading import Event, Lock
+from time import perf_counter, time
 
+from wheezy.core.collections import record_class
 from wheezy.core.introspection import import_name
 from wheezy.core.uuid import shrink_uuid
 
@@ -9,6 +22,19 @@ SESSION_STATUS_IDLE = 0
 SESSION_STATUS_ENTERED = 1
 SESSION_STATUS_ACTIVE = 2
 
+ROUTING_ROUND_ROBIN = 0
+ROUTING_LEAST_OUTSTANDING = 1
+
+RE_SQL_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+RE_SQL_SPACES = re.compile(r"\s+")
+
+NOT_FOUND = object()
+
+# serialization_failure, deadlock_detected
+RETRYABLE_SQLSTATES = ("40001", "40P01")
+# ER_LOCK_WAIT_TIMEOUT, ER_LOCK_DEADLOCK
+RETRYABLE_ERRNOS = (1205, 1213)
+
 
 class Session(object):
     """Session works with a pool of database connections.
@@ -17,21 +43,45 @@ class Session(object):
     (see `PEP0249 <http://www.python.org/dev/peps/pep-0249/>`_).
     """
 
-    __slots__ = ("pool", "status", "__connection")
+    __slots__ = (
+        "pool",
+        "stats",
+        "pinned",
+        "status",
+        "__connection",
+        "__savepoints",
+        "__streams",
+        "__pending",
+    )
 
-    def __init__(self, pool):
+    def __init__(self, pool, stats=None, pinned=False):
         """Initialize a new instance of database session.
 
         The *pool* argument is an object that implement pooling
         interface (acquire/get_back).
+
+        The optional *stats* argument is a `QueryStats` instance; if
+        provided, a time spent in pool acquire is recorded and
+        `cursor` returns an `InstrumentedCursor`.
+
+        If *pinned* is true, the connection is kept across commits and
+        returned to the pool on exit only.
         """
         self.pool = pool
+        self.stats = stats
+        self.pinned = pinned
         self.status = SESSION_STATUS_IDLE
         self.__connection = None
+        self.__savepoints = 0
+        self.__streams = 0
+        self.__pending = False
 
     def __enter__(self):
         assert self.status == SESSION_STATUS_IDLE
         self.status = SESSION_STATUS_ENTERED
+        self.__savepoints = 0
+        self.__streams = 0
+        self.__pending = False
         return self
 
     @property
@@ -42,7 +92,13 @@ class Session(object):
         if self.__connection:
             return self.__connection
         assert self.status == SESSION_STATUS_ENTERED
-        self.__connection = connection = self.pool.acquire()
+        if self.stats is None:
+            connection = self.pool.acquire()
+        else:
+            started = perf_counter()
+            connection = self.pool.acquire()
+            self.stats.record_acquire(perf_counter() - started)
+        self.__connection = connection
         self.status = SESSION_STATUS_ACTIVE
         self.on_active(connection)
         return connection
@@ -52,13 +108,27 @@ class Session(object):
 
     def cursor(self, *args, **kwargs):
         """Return a new cursor object using the session connection."""
-        return self.connection.cursor(*args, **kwargs)
+        self.__pending = True
+        return self.__cursor(*args, **kwargs)
+
+    def __cursor(self, *args, **kwargs):
+        cursor = self.connection.cursor(*args, **kwargs)
+        if self.stats is None:
+            return cursor
+        return InstrumentedCursor(cursor, self.stats)
 
     def commit(self):
-        """Commit any pending transaction to the database."""
+        """Commit any pending transaction to the database.
+
+        The connection is kept while a `stream` is open.
+        """
         assert self.status != SESSION_STATUS_IDLE
         if self.status != SESSION_STATUS_ACTIVE:
             return
+        self.__pending = False
+        if self.pinned or self.__streams:
+            self.__connection.commit()
+            return
         self.status = SESSION_STATUS_ENTERED
         connection = self.__connection
         self.__connection = None
@@ -67,9 +137,136 @@ class Session(object):
         finally:
             self.pool.get_back(connection)
 
+    def fetchall(self, sql, params=None, factory=None):
+        """Execute *sql* query and return all rows of the result.
+
+        The *factory* is a callable that builds the result from cursor
+        ``description`` and a list of rows, e.g. `record_rows` or
+        `columnar_rows`. If it is ``None`` rows are returned as is.
+        """
+        cursor = self.cursor()
+        try:
+            if params is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, params)
+            rows = cursor.fetchall()
+            if factory is None:
+                return rows
+            return factory(cursor.description, rows)
+        finally:
+            cursor.close()
+
+    def savepoint(self, name=None):
+        """Return a context manager of a nested transaction scope, see
+        `Savepoint`. A unique *name* is generated if not provided.
+        """
+        assert self.status != SESSION_STATUS_IDLE
+        if name is None:
+            self.__savepoints += 1
+            name = "sp%d" % self.__savepoints
+        return Savepoint(self, name)
+
+    def bulk_execute(
+        self, sql, rows, batch_size=1000, commit=False, progress=None
+    ):
+        """Execute *sql* against every row from *rows* iterable in
+        chunks of *batch_size* rows passed to cursor ``executemany``.
+        Only one chunk is held in memory at a time.
+
+        If *commit* is true, the session is committed after each chunk.
+
+        The *progress* callable, if provided, is called after each chunk
+        with a total number of rows processed and elapsed time in
+        seconds, e.g. to report throughput.
+
+        Returns a total number of rows processed.
+        """
+        assert batch_size > 0
+        rows = iter(rows)
+        total = 0
+        started = time()
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            cursor = self.cursor()
+            try:
+                cursor.executemany(sql, batch)
+            finally:
+                cursor.close()
+            total += len(batch)
+            if commit:
+                self.commit()
+            if progress:
+                progress(total, time() - started)
+        return total
+
+    def stream(self, sql, params=None, batch_size=1000, *args, **kwargs):
+        """Return a generator over rows of *sql* query result that
+        fetches rows in batches of *batch_size* with cursor
+        ``fetchmany``, so the whole result set is never held in
+        memory.
+
+        Extra *args* and *kwargs* are passed to the cursor factory,
+        e.g. a cursor name to get a server side cursor from drivers
+        that support it.
+
+        The query is executed by this call. The connection is kept by
+        the session until the last open stream is exhausted or closed,
+        even if the session is committed while iterating. Then the
+        cursor is closed and the connection is returned to the pool,
+        unless the session is pinned or there is work not committed
+        yet, which is committed (or rolled back) as usual.
+        """
+        assert batch_size > 0
+        cursor = self.__cursor(*args, **kwargs)
+        try:
+            if params is None:
+                cursor.execute(sql)
+            else:
+                cursor.execute(sql, params)
+        except Exception:
+            cursor.close()
+            raise
+        rows = self.__stream(cursor, batch_size)
+        next(rows)
+        return rows
+
+    def __stream(self, cursor, batch_size):
+        connection = self.__connection
+        self.__streams += 1
+        try:
+            yield
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            try:
+                cursor.close()
+            finally:
+                self.__end_stream(connection)
+
+    def __end_stream(self, connection):
+        if connection is not self.__connection:
+            return
+        self.__streams -= 1
+        if self.__streams or self.__pending or self.pinned:
+            return
+        self.status = SESSION_STATUS_ENTERED
+        self.__release()
+
     def __exit__(self, exc_type, exc_value, traceback):
         self.status = SESSION_STATUS_IDLE
+        self.__release()
+
+    def __release(self):
         connection = self.__connection
+        self.__streams = 0
+        self.__pending = False
         if connection:
             self.__connection = None
             try:
@@ -78,6 +275,705 @@ class Session(object):
                 self.pool.get_back(connection)
 
 
+def tuple_rows(description, rows):
+    """Return *rows* as a list of tuples.
+
+    >>> tuple_rows((('id',),), [[1], [2]])
+    [(1,), (2,)]
+    """
+    return [tuple(row) for row in rows]
+
+
+def record_rows(description, rows):
+    """Return *rows* as a list of records, see `record_class`.
+
+    >>> record_rows((('id',), ('name',)), [(1, 'x')])
+    [Record(id=1, name='x')]
+    """
+    make = record_class(tuple(d[0] for d in description))._make
+    return [make(row) for row in rows]
+
+
+def columnar_rows(description, rows):
+    """Return *rows* as a dictionary of column name to a list of
+    column values.
+
+    >>> sorted(columnar_rows((('id',), ('name',)), [(1, 'x'), (2, 'y')]
+    ...     ).items())
+    [('id', [1, 2]), ('name', ['x', 'y'])]
+    >>> columnar_rows((('id',),), [])
+    {'id': []}
+    """
+    names = [d[0] for d in description]
+    if not rows:
+        return {name: [] for name in names}
+    return dict(zip(names, map(list, zip(*rows))))
+
+
+class Savepoint(object):
+    """Nested transaction scope implemented with SQL savepoints.
+
+    On enter a savepoint is established. If the scope completes
+    normally the savepoint is released, otherwise work done in scope is
+    rolled back to the savepoint and an error is propagated, while the
+    outer transaction remains usable.
+
+    Here is an example::
+
+        with session:
+            for batch in batches:
+                try:
+                    with session.savepoint():
+                        session.bulk_execute(sql, batch)
+                except DatabaseError:
+                    pass  # only this batch is discarded
+            session.commit()
+    """
+
+    __slots__ = ("session", "name")
+
+    def __init__(self, session, name):
+        self.session = session
+        self.name = name
+
+    def __enter__(self):
+        self.execute("SAVEPOINT " + self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute("RELEASE SAVEPOINT " + self.name)
+        else:
+            self.execute("ROLLBACK TO SAVEPOINT " + self.name)
+
+    def execute(self, sql):
+        cursor = self.session.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+
+
+class ReplicaRouter(object):
+    """Routes units of work to one of reader (replica) pools. Implements
+    pooling interface (acquire/get_back), so it can be used as a pool
+    for `Session`.
+
+    The pool is picked by *policy*: ``ROUTING_ROUND_ROBIN`` or
+    ``ROUTING_LEAST_OUTSTANDING``.
+
+    A time to acquire a connection from a pool, that is to connect to
+    the replica or wait for a free connection, is tracked per pool as
+    an exponentially weighted moving average with *decay* smoothing
+    factor (see ``latency``). It does not include a time the caller
+    holds the connection. Pools with latency above
+    *max_latency* seconds are skipped unless all pools are slow; the
+    latency of a skipped pool fades by *decay* each time it is skipped,
+    so it is probed again later.
+    """
+
+    def __init__(
+        self, pools, policy=ROUTING_ROUND_ROBIN, max_latency=None, decay=0.2
+    ):
+        assert pools
+        assert 0.0 < decay <= 1.0
+        self.pools = list(pools)
+        self.policy = policy
+        self.max_latency = max_latency
+        self.decay = decay
+        self.outstanding = [0] * len(self.pools)
+        self.latency = [0.0] * len(self.pools)
+        self.counter = 0
+        self.lock = Lock()
+        self.acquired = {}
+
+    def select(self):
+        """Return an index of a pool to route the next unit of work."""
+        with self.lock:
+            candidates = self.candidates()
+            if self.policy == ROUTING_LEAST_OUTSTANDING:
+                index = min(candidates, key=self.outstanding.__getitem__)
+            else:
+                index = candidates[self.counter % len(candidates)]
+                self.counter += 1
+            self.outstanding[index] += 1
+            return index
+
+    def candidates(self):
+        """Return indexes of pools with latency within ``max_latency``
+        or all pools if none fits.
+        """
+        max_latency = self.max_latency
+        if max_latency is None:
+            return range(len(self.pools))
+        latency = self.latency
+        candidates = []
+        for i, value in enumerate(latency):
+            if value > max_latency:
+                latency[i] = value * (1.0 - self.decay)
+            else:
+                candidates.append(i)
+        return candidates or range(len(self.pools))
+
+    def acquire(self):
+        """Acquire a connection from the selected reader pool."""
+        index = self.select()
+        started = perf_counter()
+        try:
+            connection = self.pools[index].acquire()
+        except Exception:
+            with self.lock:
+                self.outstanding[index] -= 1
+            raise
+        elapsed = perf_counter() - started
+        with self.lock:
+            latency = self.latency[index]
+            self.latency[index] = latency + self.decay * (elapsed - latency)
+        self.acquired[id(connection)] = index
+        return connection
+
+    def get_back(self, connection):
+        """Return the connection back to the pool it was acquired from."""
+        index = self.acquired.pop(id(connection))
+        with self.lock:
+            self.outstanding[index] -= 1
+        self.pools[index].get_back(connection)
+
+
+class RoutingSession(object):
+    """Read/write splitting session. Writes are sent to a *pool* of
+    primary database connections while reads are routed to replica
+    pools by *router* (see `ReplicaRouter`).
+
+    Once a write cursor is requested the session is pinned to the
+    primary, so any further reads in the same scope see own writes.
+    """
+
+    __slots__ = ("writer", "reader", "status", "pinned")
+
+    def __init__(self, pool, router):
+        self.writer = Session(pool)
+        self.reader = Session(router)
+        self.status = SESSION_STATUS_IDLE
+        self.pinned = False
+
+    def __enter__(self):
+        assert self.status == SESSION_STATUS_IDLE
+        self.status = SESSION_STATUS_ENTERED
+        self.writer.__enter__()
+        self.reader.__enter__()
+        return self
+
+    @property
+    def connection(self):
+        """Return the primary connection and pin the session to it.
+        Not intended to be used directly, use `cursor` method instead.
+        """
+        self.pin()
+        return self.writer.connection
+
+    def pin(self):
+        """Pin the session to the primary. A replica connection, if any,
+        is returned back to the pool.
+        """
+        if not self.pinned:
+            self.pinned = True
+            self.reader.commit()
+        self.status = SESSION_STATUS_ACTIVE
+
+    def cursor(self, *args, **kwargs):
+        """Return a new cursor object using the primary connection."""
+        self.pin()
+        return self.writer.cursor(*args, **kwargs)
+
+    def read_cursor(self, *args, **kwargs):
+        """Return a new cursor object using a replica connection, or
+        the primary one if the session is pinned.
+        """
+        if self.pinned:
+            return self.writer.cursor(*args, **kwargs)
+        cursor = self.reader.cursor(*args, **kwargs)
+        self.status = SESSION_STATUS_ACTIVE
+        return cursor
+
+    def commit(self):
+        """Commit any pending transaction to the database."""
+        assert self.status != SESSION_STATUS_IDLE
+        if self.status != SESSION_STATUS_ACTIVE:
+            return
+        self.status = SESSION_STATUS_ENTERED
+        try:
+            self.writer.commit()
+        finally:
+            self.reader.commit()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.status = SESSION_STATUS_IDLE
+        self.pinned = False
+        try:
+            self.reader.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.writer.__exit__(exc_type, exc_value, traceback)
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(sql):
+    """Return *sql* statement with literals replaced by ``?`` and
+    whitespace collapsed, so statements that differ by literal values
+    only are accounted together.
+
+    >>> normalize_sql("SELECT *  FROM t\\n WHERE id = 10 AND n = 'x'")
+    'SELECT * FROM t WHERE id = ? AND n = ?'
+    """
+    return RE_SQL_SPACES.sub(" ", RE_SQL_LITERALS.sub("?", sql)).strip()
+
+
+class StatementStats(object):
+    """Accumulated timing of a normalized SQL statement."""
+
+    __slots__ = ("count", "total", "max", "rows")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    @property
+    def average(self):
+        return self.count and self.total / self.count or 0.0
+
+
+class QueryStats(object):
+    """Collects per statement (normalized SQL) execution counts,
+    total/max latency and rows fetched, as well as time spent waiting
+    for pool acquire. Shared by sessions, see `Session`.
+
+    The *slow_query* callable, if provided, is called with the SQL
+    statement and elapsed time for each execution that takes at least
+    *slow_threshold* seconds.
+    """
+
+    def __init__(self, slow_query=None, slow_threshold=1.0):
+        self.slow_query = slow_query
+        self.slow_threshold = slow_threshold
+        self.lock = Lock()
+        self.statements = {}
+        self.acquire_count = 0
+        self.acquire_time = 0.0
+
+    def record_acquire(self, elapsed):
+        """Record a time spent waiting for pool acquire."""
+        with self.lock:
+            self.acquire_count += 1
+            self.acquire_time += elapsed
+
+    def record(self, sql, elapsed):
+        """Record execution of *sql* statement that took *elapsed*
+        seconds.
+        """
+        key = normalize_sql(sql)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is None:
+                self.statements[key] = stats = StatementStats()
+            stats.count += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+        if self.slow_query and elapsed >= self.slow_threshold:
+            self.slow_query(sql, elapsed)
+
+    def record_rows(self, sql, rows):
+        """Record a number of *rows* fetched for *sql* statement."""
+        key = normalize_sql(sql)
+        with self.lock:
+            stats = self.statements.get(key)
+            if stats is not None:
+                stats.rows += rows
+
+    @property
+    def execute_time(self):
+        """Returns a total time spent executing statements."""
+        return sum(s.total for s in self.statements.values())
+
+    def top(self, n=10, key="total"):
+        """Returns a list of (sql, `StatementStats`) pairs for top *n*
+        statements ordered by *key*: ``total``, ``max``, ``average``,
+        ``count`` or ``rows``.
+        """
+        with self.lock:
+            items = list(self.statements.items())
+        key = attrgetter(key)
+        return nlargest(n, items, key=lambda item: key(item[1]))
+
+    def report(self, n=10, key="total"):
+        """Prints top *n* statements ordered by *key*."""
+        print(
+            "acquire: %d x %.3fs, execute: %.3fs"
+            % (self.acquire_count, self.acquire_time, self.execute_time)
+        )
+        print("count    total      avg      max    rows sql")
+        for sql, s in self.top(n, key):
+            print(
+                "%5d %7.3fs %7.3fs %7.3fs %7d %s"
+                % (s.count, s.total, s.average, s.max, s.rows, sql)
+            )
+
+
+class InstrumentedCursor(object):
+    """Wraps a database cursor and records statements execution time
+    and rows fetched into `QueryStats`.
+    """
+
+    __slots__ = ("cursor", "stats", "sql")
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+        self.sql = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        rows = 0
+        try:
+            for row in self.cursor:
+                rows += 1
+                yield row
+        finally:
+            if self.sql is not None:
+                self.stats.record_rows(self.sql, rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cursor.close()
+
+    def execute(self, sql, *args):
+        self.sql = sql
+        started = perf_counter()
+        try:
+            return self.cursor.execute(sql, *args)
+        finally:
+            self.stats.record(sql, perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        self.sql = sql
+        started = perf_counter()
+        try:
+            return self.cursor.executemany(sql, seq_of_parameters)
+        finally:
+            self.stats.record(sql, perf_counter() - started)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None and self.sql is not None:
+            self.stats.record_rows(self.sql, 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        if self.sql is not None:
+            self.stats.record_rows(self.sql, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        if self.sql is not None:
+            self.stats.record_rows(self.sql, len(rows))
+        return rows
+
+
+class QueryCache(object):
+    """A bounded in-process LRU cache of query results with time to
+    live and table tags, see `CachedSession`.
+
+    Holds up to *maxsize* entries, each expires in *ttl* seconds
+    unless overridden per entry. In *single_flight* mode concurrent
+    misses of the same key wait for a single load.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, single_flight=True):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.single_flight = single_flight
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.tags = {}
+        self.loading = {}
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return a value for *key* if it is cached and not expired."""
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                if entry[0] > time():
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return entry[2]
+                self.remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, tags=(), ttl=None):
+        """Cache *value* by *key* tagged with *tags*."""
+        with self.lock:
+            self.store(key, value, tags, ttl)
+
+    def store(self, key, value, tags, ttl):
+        """Store *value* by *key*, the lock must be held by the caller."""
+        expires = time() + (self.ttl if ttl is None else ttl)
+        if key in self.items:
+            self.remove(key)
+        elif len(self.items) >= self.maxsize:
+            self.remove(next(iter(self.items)))
+        self.items[key] = (expires, tags, value)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+
+    def remove(self, key):
+        """Remove *key*, the lock must be held by the caller."""
+        expires, tags, value = self.items.pop(key)
+        for tag in tags:
+            keys = self.tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tags[tag]
+
+    def invalidate(self, *tags):
+        """Remove all entries tagged with any of *tags*."""
+        with self.lock:
+            generations = self.generations
+            for tag in tags:
+                generations[tag] = generations.get(tag, 0) + 1
+                for key in list(self.tags.get(tag, ())):
+                    self.remove(key)
+
+    def get_or_load(self, key, load, tags=(), ttl=None):
+        """Return a cached value for *key* or call *load* to get it."""
+        value = self.get(key, NOT_FOUND)
+        if value is not NOT_FOUND:
+            return value
+        if not self.single_flight:
+            return self.load(key, load, tags, ttl)
+        with self.lock:
+            event = self.loading.get(key)
+            if event is None:
+                self.loading[key] = Event()
+        if event is not None:
+            event.wait()
+            value = self.get(key, NOT_FOUND)
+            if value is not NOT_FOUND:
+                return value
+            return self.load(key, load, tags, ttl)
+        try:
+            return self.load(key, load, tags, ttl)
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def load(self, key, load, tags, ttl):
+        generations = self.generations
+        before = [generations.get(tag, 0) for tag in tags]
+        value = load()
+        with self.lock:
+            # a tag invalidated while loading makes the value stale
+            if before == [generations.get(tag, 0) for tag in tags]:
+                self.store(key, value, tags, ttl)
+        return value
+
+
+class CachedSession(object):
+    """Wraps a *session* with a read-through `QueryCache`.
+
+    Reads marked cacheable with `fetchall` are tagged by tables they
+    depend on. Tables written in scope are marked with `touch`; a
+    successful commit invalidates cache entries with these tags.
+    """
+
+    __slots__ = ("session", "cache", "touched")
+
+    def __init__(self, session, cache):
+        self.session = session
+        self.cache = cache
+        self.touched = set()
+
+    @property
+    def status(self):
+        return self.session.status
+
+    @property
+    def connection(self):
+        return self.session.connection
+
+    def __enter__(self):
+        self.session.__enter__()
+        return self
+
+    def cursor(self, *args, **kwargs):
+        """Return a new cursor object using the session connection."""
+        return self.session.cursor(*args, **kwargs)
+
+    def fetchall(self, sql, params=None, tags=(), ttl=None, factory=None):
+        """Return all rows of *sql* query result built by *factory*
+        (see `Session.fetchall`), read through cache if *tags* are
+        given. Tables touched in scope are always read from database.
+
+        A cached result is shared, so each caller gets a copy of its
+        list (or dict of column lists); rows are not copied.
+        """
+        session = self.session
+        if not tags or self.touched.intersection(tags):
+            return session.fetchall(sql, params, factory)
+        return copy_result(
+            self.cache.get_or_load(
+                (sql, make_params_key(params), factory),
+                lambda: session.fetchall(sql, params, factory),
+                tags,
+                ttl,
+            )
+        )
+
+    def touch(self, *tags):
+        """Mark tables (tags) as written in this scope."""
+        self.touched.update(tags)
+
+    def commit(self):
+        """Commit any pending transaction to the database and
+        invalidate cache entries of touched tables.
+        """
+        self.session.commit()
+        if self.touched:
+            self.cache.invalidate(*self.touched)
+            self.touched.clear()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.touched.clear()
+        self.session.__exit__(exc_type, exc_value, traceback)
+
+
+def copy_result(result):
+    """Return a shallow copy of a query *result*.
+
+    >>> r = {'id': [1]}
+    >>> c = copy_result(r)
+    >>> c == r, c['id'] is r['id']
+    (True, False)
+    """
+    if isinstance(result, dict):
+        return {name: list(values) for name, values in result.items()}
+    return list(result)
+
+
+def make_params_key(params):
+    """Return a hashable key for query *params*.
+
+    >>> make_params_key({'b': 2, 'a': [1]})
+    (('a', (1,)), ('b', 2))
+    >>> make_params_key([1, 'x'])
+    (1, 'x')
+    """
+    if isinstance(params, dict):
+        return tuple(
+            (k, make_params_key(v)) for k, v in sorted(params.items())
+        )
+    if isinstance(params, (list, tuple)):
+        return tuple(make_params_key(v) for v in params)
+    return params
+
+
+def is_retryable_error(error):
+    """Return ``True`` if *error* is a deadlock or serialization
+    failure reported by driver per SQLSTATE (``pgcode`` or ``sqlstate``
+    attribute) or MySQL error number (the first argument).
+    """
+    code = getattr(error, "pgcode", None) or getattr(error, "sqlstate", None)
+    if code is not None:
+        return code in RETRYABLE_SQLSTATES
+    args = error.args
+    return bool(args) and args[0] in RETRYABLE_ERRNOS
+
+
+class RetryTransaction(object):
+    """Runs a unit of work in a session and commits it, retrying the
+    whole unit of work when it fails with a retryable error.
+
+    ``session_factory`` - a callable that returns a new session.
+
+    ``retry`` - a retry function, see
+    :py:meth:`~wheezy.core.retry.make_retry`.
+
+    ``is_retryable`` - a predicate that classifies driver errors.
+
+    ``on_retry`` - an optional callable called with an error and
+    attempt number each time a retryable error occurs.
+
+    Example::
+
+        transaction = RetryTransaction(
+            lambda: Session(pool),
+            make_retry(timeout=5.0, start=0.05, end=1.0, slope=2.0),
+        )
+        transaction(lambda session: update_balance(session, 100))
+    """
+
+    def __init__(
+        self,
+        session_factory,
+        retry,
+        is_retryable=is_retryable_error,
+        on_retry=None,
+    ):
+        self.session_factory = session_factory
+        self.retry = retry
+        self.is_retryable = is_retryable
+        self.on_retry = on_retry
+        self.lock = Lock()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def __call__(self, work):
+        """Return a result of *work* called with a session. The last
+        retryable error is raised if retry timed out.
+        """
+        state = [0, None, None]
+
+        def attempt():
+            state[0] += 1
+            try:
+                with self.session_factory() as session:
+                    state[1] = work(session)
+                    session.commit()
+            except Exception as error:
+                if not self.is_retryable(error):
+                    raise
+                state[2] = error
+                if self.on_retry:
+                    self.on_retry(error, state[0])
+                return False
+            return True
+
+        try:
+            succeeded = self.retry(attempt)
+        finally:
+            with self.lock:
+                self.calls += 1
+                self.retries += state[0] - 1
+        if not succeeded:
+            with self.lock:
+                self.failures += 1
+            raise state[2]
+        return state[1]
+
+
 class TPCSession(object):
     """Two-Phase Commit protocol session that works with a pool of
     database connections.
@@ -92,17 +988,29 @@ class TPCSession(object):
         "branch_qualifier",
         "enlised_sessions",
         "status",
+        "executor",
     )
 
     def __init__(
-        self, format_id=7, global_transaction_id=None, branch_qualifier=""
+        self,
+        format_id=7,
+        global_transaction_id=None,
+        branch_qualifier="",
+        executor=None,
     ):
         """Initialize a new instance of Two-Phase Commit protocol database
         session.
+
+        The optional *executor* argument is a
+        ``concurrent.futures.Executor`` (e.g. ``ThreadPoolExecutor``);
+        if provided, prepare and commit phases run concurrently over
+        enlisted connections, so commit latency is about a single round
+        trip per phase.
         """
         self.format_id = format_id
         self.global_transaction_id = global_transaction_id
         self.branch_qualifier = branch_qualifier
+        self.executor = executor
         self.enlised_sessions = []
         self.status = SESSION_STATUS_IDLE
 
@@ -136,15 +1044,28 @@ class TPCSession(object):
         connections = [
             s.connection for s in sessions if s.status == SESSION_STATUS_ACTIVE
         ]
-        for c in connections:
-            c.tpc_prepare()
-        for c in connections:
-            c.tpc_commit()
+        self.run_phase([c.tpc_prepare for c in connections])
+        self.run_phase([c.tpc_commit for c in connections])
         for s in sessions:
             s.__exit__(None, None, None)
         self.enlised_sessions = []
         self.status = SESSION_STATUS_ENTERED
 
+    def run_phase(self, calls):
+        """Run *calls* one after another, stopping at the first error,
+        or concurrently if executor is set, in which case the first
+        error is raised once all calls completed.
+        """
+        executor = self.executor
+        if executor is None or len(calls) < 2:
+            for call in calls:
+                call()
+            return
+        futures = [executor.submit(call) for call in calls]
+        wait(futures)
+        for future in futures:
+            future.result()
+
     def __exit__(self, exc_type, exc_value, traceback):
         sessions = self.enlised_sessions
         self.status = SESSION_STATUS_IDLE
@@ -162,6 +1083,217 @@ class TPCSession(object):
             s.__exit__(exc_type, exc_value, traceback)
 
 
+class AsyncSession(object):
+    """Asynchronous session that works with a pool of database
+    connections.
+
+    The *pool* and connections are expected to be asynchronous, e.g.
+    ``acquire`` returns an awaitable. For drivers that are blocking
+    only set *blocking* to offload pool and connection calls to a
+    thread *executor* (default executor of the running loop if
+    ``None``).
+    """
+
+    __slots__ = ("pool", "blocking", "executor", "status", "__connection")
+
+    def __init__(self, pool, blocking=False, executor=None):
+        self.pool = pool
+        self.blocking = blocking
+        self.executor = executor
+        self.status = SESSION_STATUS_IDLE
+        self.__connection = None
+
+    async def __aenter__(self):
+        assert self.status == SESSION_STATUS_IDLE
+        self.status = SESSION_STATUS_ENTERED
+        return self
+
+    async def call(self, f, *args, **kwargs):
+        """Call *f* offloading it to executor if the session is
+        blocking, otherwise await the result if it is awaitable.
+        """
+        if self.blocking:
+            return await get_running_loop().run_in_executor(
+                self.executor, partial(f, *args, **kwargs)
+            )
+        result = f(*args, **kwargs)
+        if isawaitable(result):
+            result = await result
+        return result
+
+    async def connection(self):
+        """Return the session connection. Not intended to be used
+        directly, use `cursor` method instead.
+        """
+        if self.__connection:
+            return self.__connection
+        assert self.status == SESSION_STATUS_ENTERED
+        self.__connection = connection = await self.call(self.pool.acquire)
+        self.status = SESSION_STATUS_ACTIVE
+        await self.on_active(connection)
+        return connection
+
+    async def on_active(self, connection):
+        pass
+
+    async def cursor(self, *args, **kwargs):
+        """Return a new cursor object using the session connection.
+        A cursor of blocking session is wrapped by `AsyncCursor`.
+        """
+        connection = await self.connection()
+        cursor = await self.call(connection.cursor, *args, **kwargs)
+        if self.blocking:
+            return AsyncCursor(cursor, self)
+        return cursor
+
+    async def commit(self):
+        """Commit any pending transaction to the database."""
+        assert self.status != SESSION_STATUS_IDLE
+        if self.status != SESSION_STATUS_ACTIVE:
+            return
+        self.status = SESSION_STATUS_ENTERED
+        connection = self.__connection
+        self.__connection = None
+        try:
+            await self.call(connection.commit)
+        finally:
+            await self.call(self.pool.get_back, connection)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.status = SESSION_STATUS_IDLE
+        connection = self.__connection
+        if connection:
+            self.__connection = None
+            try:
+                await self.call(connection.rollback)
+            finally:
+                await self.call(self.pool.get_back, connection)
+
+
+class AsyncCursor(object):
+    """Wraps a blocking database cursor, so its operations are
+    offloaded to the *session* executor and can be awaited.
+    """
+
+    __slots__ = ("cursor", "session")
+
+    def __init__(self, cursor, session):
+        self.cursor = cursor
+        self.session = session
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    async def execute(self, sql, *args):
+        return await self.session.call(self.cursor.execute, sql, *args)
+
+    async def executemany(self, sql, seq_of_parameters):
+        return await self.session.call(
+            self.cursor.executemany, sql, seq_of_parameters
+        )
+
+    async def fetchone(self):
+        return await self.session.call(self.cursor.fetchone)
+
+    async def fetchmany(self, *args):
+        return await self.session.call(self.cursor.fetchmany, *args)
+
+    async def fetchall(self):
+        return await self.session.call(self.cursor.fetchall)
+
+    async def close(self):
+        return await self.session.call(self.cursor.close)
+
+
+class AsyncTPCSession(object):
+    """Asynchronous Two-Phase Commit protocol session that works with
+    `AsyncSession` instances. Prepare and commit phases run
+    concurrently over enlisted connections.
+    """
+
+    __slots__ = (
+        "format_id",
+        "global_transaction_id",
+        "branch_qualifier",
+        "enlised_sessions",
+        "status",
+    )
+
+    def __init__(
+        self, format_id=7, global_transaction_id=None, branch_qualifier=""
+    ):
+        self.format_id = format_id
+        self.global_transaction_id = global_transaction_id
+        self.branch_qualifier = branch_qualifier
+        self.enlised_sessions = []
+        self.status = SESSION_STATUS_IDLE
+
+    async def __aenter__(self):
+        assert self.status == SESSION_STATUS_IDLE
+        assert not self.enlised_sessions
+        self.status = SESSION_STATUS_ENTERED
+        return self
+
+    async def enlist(self, session):
+        """Begins a TPC transaction with the given session."""
+        assert session
+        assert self.status != SESSION_STATUS_IDLE
+        self.enlised_sessions.append(session)
+        await session.__aenter__()
+        c = await session.connection()
+        xid = c.xid(
+            self.format_id,
+            self.global_transaction_id or shrink_uuid(uuid4()),
+            self.branch_qualifier,
+        )
+        await session.call(c.tpc_begin, xid)
+        self.status = SESSION_STATUS_ACTIVE
+
+    async def commit(self):
+        """Commit any pending transaction to the database."""
+        assert self.status != SESSION_STATUS_IDLE
+        if self.status != SESSION_STATUS_ACTIVE:
+            return
+        sessions = self.enlised_sessions
+        active = [s for s in sessions if s.status == SESSION_STATUS_ACTIVE]
+        connections = [await s.connection() for s in active]
+        await self.run_phase(
+            [s.call(c.tpc_prepare) for s, c in zip(active, connections)]
+        )
+        await self.run_phase(
+            [s.call(c.tpc_commit) for s, c in zip(active, connections)]
+        )
+        for s in sessions:
+            await s.__aexit__(None, None, None)
+        self.enlised_sessions = []
+        self.status = SESSION_STATUS_ENTERED
+
+    async def run_phase(self, calls):
+        """Await *calls* concurrently and raise the first error once
+        all of them completed.
+        """
+        for result in await gather(*calls, return_exceptions=True):
+            if isinstance(result, BaseException):
+                raise result
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        sessions = self.enlised_sessions
+        self.status = SESSION_STATUS_IDLE
+        self.enlised_sessions = []
+        for s in sessions:
+            if s.status == SESSION_STATUS_ACTIVE:
+                try:
+                    c = await s.connection()
+                    await s.call(c.tpc_rollback)
+                except Exception:
+                    warnings.warn(
+                        "An error occured while rolling back "
+                        "two phase transaction.",
+                        stacklevel=2,
+                    )
+            await s.__aexit__(exc_type, exc_value, traceback)
+
+
 class NullSession(object):
     """Null session is supposed to be used in mock scenarios."""
 
@@ -188,6 +1320,34 @@ class NullSession(object):
         assert self.status != SESSION_STATUS_IDLE
         self.status = SESSION_STATUS_ENTERED
 
+    def fetchall(self, sql, params=None, factory=None):
+        """Return an empty list. Asserts the session is used in scope."""
+        assert self.status == SESSION_STATUS_ENTERED
+        return []
+
+    def savepoint(self, name=None):
+        """Return a noop context manager. Asserts the session is used
+        in scope.
+        """
+        assert self.status == SESSION_STATUS_ENTERED
+        return nullcontext()
+
+    def bulk_execute(self, sql, rows, batch_size=1000, **kwargs):
+        """Consumes *rows* and returns a number of rows. Asserts the
+        session is used in scope.
+        """
+        assert self.status == SESSION_STATUS_ENTERED
+        assert batch_size > 0
+        return sum(1 for _ in rows)
+
+    def stream(self, sql, params=None, batch_size=1000, *args, **kwargs):
+        """Return an empty iterator. Asserts the session is used in
+        scope.
+        """
+        assert self.status == SESSION_STATUS_ENTERED
+        assert batch_size > 0
+        return iter(())
+
     def __exit__(self, exc_type, exc_value, traceback):
         assert self.status == SESSION_STATUS_ENTERED
         self.status = SESSION_STATUS_IDLE
@@ -1,10 +1,741 @@
-from http.client import HTTPConnection, HTTPSConnection
+import os
+import re
+import zlib
+from asyncio import (
+    IncompleteReadError,
+    Semaphore,
+    ensure_future,
+    open_connection,
+    wait,
+    wait_for,
+)
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from copy import copy
+from email.utils import parsedate_to_datetime
+from functools import partial
+from hashlib import sha1
+from http.client import (
+    HTTPConnection,
+    HTTPSConnection,
+    InvalidURL,
+    RemoteDisconnected,
+)
 from http.cookies import SimpleCookie
-from json import loads as json_loads
+from itertools import count
+from json import dumps as json_dumps, loads as json_loads
+from socket import (
+    SOCK_STREAM,
+    _GLOBAL_DEFAULT_TIMEOUT,
+    gaierror,
+    getaddrinfo,
+    getdefaulttimeout,
+    socket,
+)
+from threading import Lock, get_ident
+from time import perf_counter, sleep, time
 from urllib.parse import urlencode, urljoin, urlsplit
 
-from wheezy.core.collections import attrdict, defaultdict
-from wheezy.core.gzip import decompress
+from wheezy.core.collections import (
+    attrdict,
+    defaultdict,
+    gzip_iterator,
+    record_class,
+)
+from wheezy.core.gzip import compress
+from wheezy.core.pooling import LazyPool
+from wheezy.core.retry import make_retry
+
+RE_CONTROL_CHARS = re.compile("[\x00-\x20\x7f]")
+RE_HEADER_NAME = re.compile(r"[^:\s][^:\r\n]*")
+RE_ILLEGAL_HEADER_VALUE = re.compile(r"\n(?![ \t])|\r(?![ \t\n])")
+
+IDEMPOTENT_METHODS = frozenset(
+    ["GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"]
+)
+
+
+class HTTPHeaders(dict):
+    """Case insensitive multi-value HTTP headers: a dictionary of lists
+    of values by lower case header name, made of a list of name, value
+    pairs in a single pass. A missing header is an empty list, so it
+    is compatible with ``defaultdict(list)``, e.g. `first_item_adapter`.
+
+    >>> h = HTTPHeaders([('Set-Cookie', 'a=1'), ('set-cookie', 'b=2')])
+    >>> h['SET-COOKIE'], h['x']
+    (['a=1', 'b=2'], [])
+    >>> h.first('set-cookie'), h.last('set-cookie'), h.first('x', '')
+    ('a=1', 'b=2', '')
+    >>> from wheezy.core.collections import first_item_adapter
+    >>> first_item_adapter(h)['Set-Cookie']
+    'a=1'
+    >>> 'Set-Cookie' in h, 'x' in h, h.get('x')
+    (True, False, None)
+    >>> h
+    HTTPHeaders({'set-cookie': ['a=1', 'b=2']})
+    """
+
+    __slots__ = ()
+
+    def __init__(self, headers=()):
+        super(HTTPHeaders, self).__init__()
+        setdefault = super(HTTPHeaders, self).setdefault
+        for name, value in headers:
+            setdefault(name.lower(), []).append(value)
+
+    def __missing__(self, name):
+        return dict.get(self, name.lower()) or []
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or dict.__contains__(
+            self, name.lower()
+        )
+
+    def __setitem__(self, name, values):
+        dict.__setitem__(self, name.lower(), values)
+
+    def __delitem__(self, name):
+        dict.__delitem__(self, name.lower())
+
+    def __repr__(self):
+        return "HTTPHeaders(%s)" % dict.__repr__(self)
+
+    def get(self, name, default=None):
+        values = dict.get(self, name)
+        if values is None:
+            return dict.get(self, name.lower(), default)
+        return values
+
+    def pop(self, name, *default):
+        return dict.pop(self, name.lower(), *default)
+
+    def setdefault(self, name, default=None):
+        return dict.setdefault(self, name.lower(), default)
+
+    def update(self, *args, **kwargs):
+        for name, values in dict(*args, **kwargs).items():
+            self[name] = values
+
+    def copy(self):
+        h = HTTPHeaders()
+        dict.update(h, self)
+        return h
+
+    def all(self, name):
+        """Returns a list of header values."""
+        return self.get(name) or []
+
+    def first(self, name, default=None):
+        """Returns a first header value or *default*."""
+        values = self.get(name)
+        return values[0] if values else default
+
+    def last(self, name, default=None):
+        """Returns a last header value or *default*."""
+        values = self.get(name)
+        return values[-1] if values else default
+
+
+class ContentDecoder(object):
+    """Incrementally decodes ``gzip`` or ``deflate`` content encoding.
+
+    If *max_size* is set, decoding is aborted with ``ValueError`` as
+    soon as decoded content exceeds *max_size* bytes.
+
+    >>> from wheezy.core.gzip import compress
+    >>> d = ContentDecoder('gzip')
+    >>> d.decompress(compress(b'test')) + d.flush()
+    b'test'
+
+    >>> d = ContentDecoder('deflate', max_size=4)
+    >>> d.decompress(zlib.compress(b'test' * 10))
+    Traceback (most recent call last):
+        ...
+    ValueError: decoded content exceeds 4 bytes
+    """
+
+    __slots__ = ("decoder", "raw", "max_size", "size")
+
+    def __init__(self, encoding, max_size=None):
+        if encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+            self.raw = None
+        else:
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self.raw = False
+        self.max_size = max_size
+        self.size = 0
+
+    def decompress(self, data):
+        """Returns decoded part of *data*."""
+        if self.raw is None:
+            # deflate is meant to be zlib wrapped, however some servers
+            # send a raw deflate stream
+            try:
+                chunk = self.limit(self.decoder.decompress, data)
+            except zlib.error:
+                self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                chunk = self.limit(self.decoder.decompress, data)
+            self.raw = False
+            return chunk
+        return self.limit(self.decoder.decompress, data)
+
+    def flush(self):
+        """Returns the remaining decoded content."""
+        return self.limit(lambda data, n: self.decoder.flush(), b"")
+
+    def limit(self, decompress, data):
+        max_size = self.max_size
+        if max_size is None:
+            return decompress(data, 0)
+        chunk = decompress(data, max_size - self.size + 1)
+        self.size += len(chunk)
+        if self.size > max_size:
+            raise ValueError("decoded content exceeds %d bytes" % max_size)
+        return chunk
+
+
+class CachedResponse(object):
+    """A response stored in `ResponseCache`."""
+
+    __slots__ = (
+        "status",
+        "headers",
+        "body",
+        "expires",
+        "etag",
+        "last_modified",
+        "vary",
+    )
+
+    def __init__(
+        self, status, headers, body, expires, etag, last_modified, vary=()
+    ):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+        self.vary = vary
+
+    @classmethod
+    def create(cls, status, headers, body, request):
+        """Returns a new cached response for *headers* (a list of
+        name, value pairs) and decoded *body* or ``None`` if the
+        response is not cacheable. The *request* is a dictionary of
+        request headers with lower case names, the values of headers
+        listed in ``Vary`` must match to use the cached response.
+        """
+        etag = last_modified = None
+        stored = []
+        vary = []
+        for name, value in headers:
+            n = name.lower()
+            if n == "cache-control":
+                directives = value.lower()
+                if "no-store" in directives or "private" in directives:
+                    return None
+            elif n == "vary":
+                if "*" in value:
+                    return None
+                vary.extend(
+                    (v.strip(), request.get(v.strip()))
+                    for v in value.lower().split(",")
+                )
+            elif n == "etag":
+                etag = value
+            elif n == "last-modified":
+                last_modified = value
+            elif n in ("content-encoding", "content-length", "set-cookie"):
+                continue
+            stored.append((name, value))
+        expires = cache_expires(headers)
+        if not expires and not etag and not last_modified:
+            return None
+        return cls(
+            status, stored, body, expires, etag, last_modified, tuple(vary)
+        )
+
+    def matches(self, request):
+        """Checks request headers listed in ``Vary``."""
+        for name, value in self.vary:
+            if request.get(name) != value:
+                return False
+        return True
+
+    def add_validators(self, headers):
+        """Adds conditional request headers."""
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+    def dump(self):
+        """Returns a JSON serializable dictionary, except body."""
+        return {
+            "status": self.status,
+            "headers": self.headers,
+            "expires": self.expires,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "vary": self.vary,
+        }
+
+    @classmethod
+    def load(cls, data, body):
+        """Returns a cached response made by `dump`."""
+        return cls(
+            data["status"],
+            [tuple(header) for header in data["headers"]],
+            body,
+            data["expires"],
+            data["etag"],
+            data["last_modified"],
+            tuple(tuple(v) for v in data["vary"]),
+        )
+
+
+def cache_expires(headers):
+    """Returns a time when response expires per ``max-age`` directive
+    of ``Cache-Control`` header or 0 if it must be revalidated.
+
+    >>> cache_expires([('Cache-Control', 'public, max-age=0')])
+    0
+    >>> cache_expires([('Cache-Control', 'no-cache, max-age=60')])
+    0
+    >>> cache_expires([('Cache-Control', 'max-age=60')]) > time()
+    True
+    """
+    for name, value in headers:
+        if name.lower() != "cache-control":
+            continue
+        max_age = 0
+        for directive in value.lower().split(","):
+            directive = directive.strip()
+            if directive == "no-cache":
+                return 0
+            if directive.startswith("max-age="):
+                try:
+                    max_age = int(directive[8:])
+                except ValueError:
+                    return 0
+        if max_age > 0:
+            return time() + max_age
+    return 0
+
+
+class ResponseCache(object):
+    """A bounded LRU cache of responses for `HTTPClient`. Holds up to
+    *maxsize* responses in memory. If a directory *path* is given,
+    responses are stored on disk as well, so they survive restarts;
+    each as a JSON file with metadata and a file with body, up to
+    *max_disk_size* bytes in total, least recently used are removed.
+    """
+
+    def __init__(self, maxsize=256, path=None, max_disk_size=64 << 20):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.path = path
+        self.max_disk_size = max_disk_size
+        self.lock = Lock()
+        self.items = OrderedDict()
+        self.files = None
+        self.disk_size = 0
+
+    def get(self, key):
+        """Returns a cached response by *key* or ``None``."""
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                self.items.move_to_end(key)
+                return entry
+        if self.path is None:
+            return None
+        name = self.filename(key)
+        try:
+            with open(name + ".json", "rb") as f:
+                data = json_loads(f.read())
+            with open(name + ".body", "rb") as f:
+                body = f.read()
+            if data["key"] != key:
+                return None
+            entry = CachedResponse.load(data, body)
+        except (OSError, ValueError, LookupError, TypeError):
+            return None
+        self.add(key, entry)
+        with self.lock:
+            files = self.scan()
+            if name in files:
+                files.move_to_end(name)
+        return entry
+
+    def set(self, key, entry):
+        """Stores a response by *key*."""
+        self.add(key, entry)
+        if self.path is None:
+            return
+        data = entry.dump()
+        data["key"] = key
+        data = json_dumps(data).encode("utf-8")
+        size = len(data) + len(entry.body)
+        if size > self.max_disk_size:
+            return
+        name = self.filename(key)
+        for ext, content in ((".body", entry.body), (".json", data)):
+            tmp = "%s.%d.tmp" % (name, get_ident())
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, name + ext)
+        with self.lock:
+            files = self.scan()
+            self.disk_size += size - files.pop(name, 0)
+            files[name] = size
+            while self.disk_size > self.max_disk_size:
+                self.remove_files(*files.popitem(last=False))
+
+    def add(self, key, entry):
+        with self.lock:
+            self.items[key] = entry
+            self.items.move_to_end(key)
+            if len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def filename(self, key):
+        return os.path.join(self.path, sha1(key.encode("utf-8")).hexdigest())
+
+    def scan(self):
+        """Returns stored files by last modified time with sizes, the
+        lock must be held by the caller.
+        """
+        if self.files is None:
+            found = []
+            for f in os.scandir(self.path):
+                if f.name.endswith(".json"):
+                    name = f.path[:-5]
+                    try:
+                        size = f.stat().st_size
+                        size += os.stat(name + ".body").st_size
+                    except OSError:
+                        continue
+                    found.append((f.stat().st_mtime, name, size))
+            found.sort()
+            self.files = OrderedDict((n, size) for t, n, size in found)
+            self.disk_size = sum(self.files.values())
+        return self.files
+
+    def remove_files(self, name, size):
+        self.disk_size -= size
+        for ext in (".json", ".body"):
+            try:
+                os.remove(name + ext)
+            except OSError:
+                pass
+
+
+class RetryPolicy(object):
+    """A policy to retry transient failures of `HTTPClient` requests,
+    see `wheezy.core.retry.make_retry` for ``timeout``, ``start``,
+    ``end``, ``slope`` and ``step`` arguments. The ``timeout`` is
+    the overall deadline for retries.
+
+    ``methods`` - HTTP methods that are safe to retry.
+
+    ``statuses`` - response statuses that are retried, ``Retry-After``
+    response header is honoured.
+
+    ``errors`` - exceptions that are retried.
+
+    The ``end`` delay is limited to a half of ``timeout``.
+
+    Request body must be a string or bytes, so it can be sent again.
+
+    >>> RetryPolicy(timeout=1.0).end
+    0.5
+    """
+
+    def __init__(
+        self,
+        timeout=10.0,
+        start=0.1,
+        end=2.0,
+        slope=2.0,
+        step=0.0,
+        methods=IDEMPOTENT_METHODS,
+        statuses=(502, 503, 504),
+        errors=(ConnectionError, TimeoutError),
+    ):
+        end = min(start if end is None else end, timeout / 2)
+        start = min(start, end)
+        self.timeout = timeout
+        self.start = start
+        self.end = end
+        self.slope = slope
+        self.step = step
+        self.retry = make_retry(timeout, start, end, slope, step)
+        self.methods = methods
+        self.statuses = statuses
+        self.errors = errors
+
+    def allows(self, method, body):
+        return method in self.methods and isinstance(body, (str, bytes))
+
+    def delays(self):
+        """Yields delays that `retry` sleeps between attempts.
+
+        >>> d = RetryPolicy(start=0.5, end=2.0, slope=2.0).delays()
+        >>> [next(d) for i in range(4)]
+        [0.5, 1.0, 2.0, 2.0]
+        """
+        delay = self.start
+        while True:
+            yield delay
+            if delay < self.end:
+                delay = min(delay * self.slope + self.step, self.end)
+
+
+def content_charset(content_type):
+    """Returns a lower case charset of content type or ``None``.
+
+    >>> content_charset('application/json; charset="UTF-8"')
+    'utf-8'
+    >>> content_charset('application/json')
+    """
+    for param in content_type.split(";")[1:]:
+        name, sep, value = param.partition("=")
+        if sep and name.strip().lower() == "charset":
+            return value.strip().strip('"').lower()
+    return None
+
+
+def json_record(pairs):
+    """Makes a compact record (a named tuple) of JSON object key,
+    value pairs, see `wheezy.core.collections.record_class`.
+
+    >>> r = json_loads('{"id": 1, "name": "x"}', object_pairs_hook=json_record)
+    >>> r.id, r.name
+    (1, 'x')
+    """
+    names = tuple(name for name, value in pairs)
+    return record_class(names)._make(value for name, value in pairs)
+
+
+def gzip_body(body, chunk_size=65536):
+    """Returns gzip compressed request body: bytes for a string or
+    bytes, otherwise a generator of compressed chunks.
+    """
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if isinstance(body, bytes):
+        return compress(body)
+    if hasattr(body, "read"):
+        body = iter(partial(body.read, chunk_size), b"")
+    return gzip_iterator(body)
+
+
+def retry_after(headers):
+    """Returns a number of seconds to wait per ``Retry-After`` header
+    (delay seconds or HTTP date) or ``None``.
+
+    >>> retry_after({'retry-after': ['2']})
+    2.0
+    >>> retry_after({'retry-after': ['Sat, 12 Oct 2013 18:29:13 GMT']})
+    0.0
+    >>> retry_after({'retry-after': ['x']})
+    >>> retry_after({})
+    """
+    values = headers.get("retry-after")
+    if not values:
+        return None
+    value = values[-1].strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestTiming(object):
+    """Timing of a request phases in seconds since the request start:
+    ``connect`` - connection established (including TLS handshake),
+    0.0 if an open connection is reused; ``sent`` - request sent;
+    ``first_byte`` - response status and headers received;
+    ``complete`` - response body read.
+    """
+
+    __slots__ = ("start", "connect", "sent", "first_byte", "complete")
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.connect = self.sent = self.first_byte = 0.0
+        self.complete = None
+
+    def __repr__(self):
+        return (
+            "RequestTiming(connect=%.6f, sent=%.6f, first_byte=%.6f, "
+            "complete=%s)"
+            % (self.connect, self.sent, self.first_byte, self.complete)
+        )
+
+
+class Resolver(object):
+    """A cache of host name resolution shared by HTTP connections.
+
+    Addresses are cached for *ttl* seconds, failures for *negative_ttl*
+    seconds. Each connection tries the addresses of a host in turn,
+    starting with the next one (round robin).
+    """
+
+    def __init__(self, ttl=60.0, negative_ttl=5.0):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = Lock()
+        self.entries = {}
+
+    def resolve(self, host, port):
+        """Returns a list of ``getaddrinfo`` results for the host,
+        rotated round robin.
+        """
+        key = (host, port)
+        entry = self.entries.get(key)
+        now = time()
+        if entry is None or entry[0] <= now:
+            try:
+                addresses = getaddrinfo(host, port, 0, SOCK_STREAM)
+            except gaierror as error:
+                entry = [now + self.negative_ttl, error.args, 0]
+            else:
+                entry = [now + self.ttl, addresses, 0]
+            with self.lock:
+                self.entries[key] = entry
+        addresses = entry[1]
+        if not isinstance(addresses, list):
+            raise gaierror(*addresses)
+        with self.lock:
+            index = entry[2]
+            entry[2] = index + 1
+        index %= len(addresses) or 1
+        return addresses[index:] + addresses[:index]
+
+    def clear(self):
+        """Removes all cached entries."""
+        with self.lock:
+            self.entries.clear()
+
+    def create_connection(
+        self, address, timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None
+    ):
+        """Connects to *address* (a host, port tuple) like
+        `socket.create_connection`, but resolves the host via cache.
+        """
+        error = OSError("getaddrinfo returns an empty list")
+        for af, socktype, proto, canonname, sa in self.resolve(*address):
+            sock = None
+            try:
+                sock = socket(af, socktype, proto)
+                if timeout is not _GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sa)
+                return sock
+            except OSError as ex:
+                error = ex
+                if sock is not None:
+                    sock.close()
+        raise error
+
+
+default_resolver = Resolver()
+
+
+def make_connection(scheme, netloc, resolver=None):
+    """Returns a new HTTP(S) connection that resolves host names with
+    *resolver*, if any.
+    """
+    if scheme == "http":
+        connection = HTTPConnection(netloc)
+    else:
+        connection = HTTPSConnection(netloc)
+    if resolver is not None:
+        connection._create_connection = resolver.create_connection
+    return connection
+
+
+def set_timeout(connection, timeout):
+    """Sets socket *timeout* of the *connection*, ``None`` stands for
+    the default timeout.
+    """
+    if timeout is None:
+        connection.timeout = _GLOBAL_DEFAULT_TIMEOUT
+        timeout = getdefaulttimeout()
+    else:
+        connection.timeout = timeout
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+
+
+class HTTPConnectionPool(object):
+    """A pool of keep-alive HTTP connections shared by `HTTPClient`
+    instances and threads. Connections are pooled per
+    (scheme, host, port) with at most *size* connections per host;
+    acquire blocks until a connection is available.
+
+    A connection idle for longer than *idle_timeout* seconds is closed
+    and replaced by a new one on acquire. New connections resolve host
+    names with *resolver* (see `Resolver`) if given.
+    """
+
+    def __init__(self, size=10, idle_timeout=60.0, resolver=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.resolver = resolver
+        self.lock = Lock()
+        self.pools = {}
+
+    def get_pool(self, scheme, netloc):
+        """Returns a pool of connections for the host."""
+        parts = urlsplit("%s://%s" % (scheme, netloc))
+        key = (
+            scheme,
+            parts.hostname,
+            parts.port or (scheme == "http" and 80 or 443),
+        )
+        pool = self.pools.get(key)
+        if pool is None:
+            with self.lock:
+                pool = self.pools.get(key)
+                if pool is None:
+                    pool = LazyPool(
+                        self.create_factory(scheme, netloc), self.size
+                    )
+                    self.pools[key] = pool
+        return pool
+
+    def create_factory(self, scheme, netloc):
+        idle_timeout = self.idle_timeout
+        resolver = self.resolver
+
+        def create_factory(item):
+            if item is not None:
+                connection, last_used = item
+                if time() - last_used < idle_timeout:
+                    return connection
+                connection.close()
+            return make_connection(scheme, netloc, resolver)
+
+        return create_factory
+
+    def acquire(self, scheme, netloc):
+        """Return a connection to the host. Blocks until a connection
+        is available.
+        """
+        return self.get_pool(scheme, netloc).acquire()
+
+    def get_back(self, scheme, netloc, connection):
+        """Return the connection back to the pool."""
+        self.get_pool(scheme, netloc).get_back((connection, time()))
 
 
 class HTTPClient(object):
@@ -12,17 +743,61 @@ class HTTPClient(object):
     an application specific use cases, e.g. remote web server API, etc.
     """
 
-    def __init__(self, url, headers=None):
+    def __init__(
+        self,
+        url,
+        headers=None,
+        keep_alive=False,
+        pool=None,
+        max_decoded_size=None,
+        timeout=None,
+        cache=None,
+        timing=False,
+        on_timing=None,
+        retry_policy=None,
+        json_hook=attrdict,
+        resolver=None,
+    ):
         """
         `url` - a base url for interaction with remote server.
         `headers` - a dictionary of headers.
+        `keep_alive` - reuse connection between requests.
+        `pool` - a shared `HTTPConnectionPool`, implies `keep_alive`.
+        `max_decoded_size` - a limit of decoded response content size.
+        `timeout` - a socket timeout in seconds.
+        `cache` - a `ResponseCache` for GET requests.
+        `timing` - record `RequestTiming` of each request.
+        `on_timing` - a callable with the client and `RequestTiming`
+        arguments, called once a request completes, implies `timing`.
+        `retry_policy` - a `RetryPolicy` for transient failures.
+        `json_hook` - a callable that makes a JSON object from a list of
+        key, value pairs: `attrdict`, `dict` or `json_record`.
+        `resolver` - a `Resolver` to cache host name resolution, e.g.
+        `default_resolver`; with `pool` use its resolver instead.
         """
         scheme, netloc, path, query, fragment = urlsplit(url)
-        http_class = scheme == "http" and HTTPConnection or HTTPSConnection
-        self.connection = http_class(netloc)
+        self.scheme = scheme
+        self.netloc = netloc
+        self.resolver = resolver
+        self.pool = pool
+        if pool is None:
+            self.connection = self.new_connection()
+        else:
+            self.connection = None
+            keep_alive = True
+        self.keep_alive = keep_alive
+        self.max_decoded_size = max_decoded_size
+        self.timeout = timeout
+        self.cache = cache
+        self.timed = timing or on_timing is not None
+        self.on_timing = on_timing
+        self.timing = None
+        self.retry_policy = retry_policy
+        self.retries = 0
+        self.json_hook = json_hook
         self.default_headers = {
             "Accept-Encoding": "gzip",
-            "Connection": "close",
+            "Connection": keep_alive and "keep-alive" or "close",
         }
         if headers:
             self.default_headers.update(headers)
@@ -35,6 +810,7 @@ class HTTPClient(object):
         self.body = None
         self.__content = None
         self.__json = None
+        self.__stream = None
 
     @property
     def content(self):
@@ -45,10 +821,21 @@ class HTTPClient(object):
 
     @property
     def json(self):
-        """Returns a json response."""
+        """Returns a json response. It is parsed straight from the body
+        bytes unless the content type declares a charset other than
+        UTF-8/16/32. Objects are created by ``json_hook``.
+        """
         if self.__json is None:
-            assert "application/json" in self.headers["content-type"][0]
-            self.__json = json_loads(self.content, object_hook=attrdict)
+            content_type = self.headers.get("content-type", ("",))[0]
+            assert "application/json" in content_type
+            charset = content_charset(content_type)
+            body = self.body
+            if charset and not charset.startswith("utf"):
+                body = body.decode(charset)
+            hook = self.json_hook
+            self.__json = json_loads(
+                body, object_pairs_hook=hook is not dict and hook or None
+            )
         return self.__json
 
     def get(self, path, **kwargs):
@@ -75,7 +862,7 @@ class HTTPClient(object):
         """Follows HTTP redirect (e.g. status code 302)."""
         sc = self.status_code
         assert sc in [207, 301, 302, 303, 307]
-        location = self.headers["location"][0]
+        location = self.headers.first("location")
         scheme, netloc, path, query, fragment = urlsplit(location)
         method = sc == 307 and self.method or "GET"
         return self.go(path, method)
@@ -88,11 +875,14 @@ class HTTPClient(object):
         headers=None,
         content_type="",
         body="",
+        **kwargs,
     ):
         """Sends HTTP AJAX request to web server."""
         headers = headers or {}
         headers["X-Requested-With"] = "XMLHttpRequest"
-        return self.go(path, method, params, headers, content_type, body)
+        return self.go(
+            path, method, params, headers, content_type, body, **kwargs
+        )
 
     def go(
         self,
@@ -102,13 +892,224 @@ class HTTPClient(object):
         headers=None,
         content_type="",
         body="",
+        stream=False,
+        compress_body=False,
     ):
         """Sends HTTP request to web server.
 
         The ``content_type`` takes priority over ``params`` to use
-        ``body``. The ``body`` can be a string or file like object.
+        ``body``. The ``body`` can be a string, file like object or
+        an iterable of bytes (e.g. a generator); the latter is sent with
+        chunked transfer encoding and is never sent twice.
+
+        If ``compress_body`` is true, the ``body`` is gzip compressed,
+        an iterable or file like object on the fly.
+
+        If ``stream`` is true, the response body is not read; use
+        `iter_body` or `write_body` to consume it. The connection is
+        held, e.g. a slot of the shared pool, until the body is read to
+        the end, `close_stream` is called or the next request is sent.
         """
         self.method = method
+        path, body, headers = self.prepare(
+            path, method, params, headers, content_type, body
+        )
+        if compress_body and body:
+            body = gzip_body(body)
+            headers["Content-Encoding"] = "gzip"
+        self.retries = 0
+        policy = self.retry_policy
+        if policy is not None and policy.allows(method, body):
+            return self.go_retry(policy, path, method, body, headers, stream)
+        return self.fetch(path, method, body, headers, stream)
+
+    def go_retry(self, policy, path, method, body, headers, stream):
+        """Sends HTTP request and retries it per ``policy`` while
+        the request fails with a connection error or a response status
+        is transient. Returns the last response status or raises the
+        last error.
+        """
+        self.reset()
+        deadline = time() + policy.timeout
+        delays = policy.delays()
+        errors = []
+
+        def attempt():
+            if errors or self.status_code:
+                self.retries += 1
+            del errors[:]
+            try:
+                self.fetch(path, method, body, headers, stream)
+            except policy.errors as error:
+                errors.append(error)
+                next(delays)
+                return False
+            if self.status_code not in policy.statuses or time() >= deadline:
+                # no retry follows the last attempt
+                return True
+            # Retry-After replaces the backoff delay if longer
+            backoff = next(delays)
+            delay = retry_after(self.headers)
+            if delay is not None and delay > backoff:
+                if time() + delay > deadline:
+                    return True
+                sleep(delay - backoff)
+            return False
+
+        policy.retry(attempt)
+        if errors:
+            raise errors[0]
+        return self.status_code
+
+    def fetch(self, path, method, body, headers, stream):
+        self.reset()
+        key = None
+        if self.cache is not None and method == "GET" and not stream:
+            key, request, entry = self.lookup_cache(path, headers)
+            if entry is not None and entry.expires > time():
+                self.replay(entry, path)
+                return self.status_code
+
+        timing = self.timed and RequestTiming() or None
+        connection = self.acquire()
+        try:
+            r = self.send(connection, method, path, body, headers, timing)
+            if stream:
+                self.__stream = (r, connection)
+                connection = None
+            else:
+                self.body = self.read(r, connection)
+        finally:
+            if connection is not None:
+                self.release(connection)
+
+        self.process_response(r.status, r.getheaders(), path, not stream)
+        if key is not None:
+            self.process_cache(key, request, path, entry, r.getheaders())
+        if timing is not None:
+            self.timing = timing
+            if not stream:
+                self.process_timing()
+        return self.status_code
+
+    def go_many(self, requests, max_workers=4, timeout=None, deadline=None):
+        """Sends independent HTTP requests concurrently on a thread pool
+        of ``max_workers`` size.
+
+        ``requests`` - a list of dictionaries with `go` arguments.
+
+        ``timeout`` - a socket timeout per request in seconds.
+
+        ``deadline`` - a time limit for the whole batch in seconds.
+
+        Returns a list of clients (see `clone`), one per request in the
+        same order, with response state and two extra attributes:
+        ``elapsed`` - request time in seconds and ``error`` - an
+        exception raised by the request or ``TimeoutError`` if the
+        deadline was exceeded, ``None`` otherwise. A request still
+        running past the deadline completes on a detached client, so
+        the returned one is never updated later.
+        """
+        clients = [self.clone(timeout) for _ in requests]
+        executor = ThreadPoolExecutor(max_workers)
+        try:
+            futures = [
+                executor.submit(client.go_timed, request)
+                for client, request in zip(clients, requests)
+            ]
+            done, not_done = wait_futures(futures, deadline)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        for i, future in enumerate(futures):
+            if future in done:
+                client = clients[i]
+                client.error, client.elapsed = future.result()
+            else:
+                client = clients[i] = self.clone(timeout)
+                client.error = TimeoutError("deadline exceeded")
+                client.elapsed = None
+        return clients
+
+    def clone(self, timeout=None):
+        """Returns a new client that shares default headers, etags and
+        connection pool, with a copy of cookies, so it can be used
+        concurrently.
+        """
+        client = copy(self)
+        client.cookies = dict(self.cookies)
+        client.headers = None
+        client.__stream = None
+        client.reset()
+        if timeout is not None:
+            client.timeout = timeout
+        if self.pool is None:
+            client.connection = self.new_connection()
+        return client
+
+    def go_timed(self, request):
+        started = perf_counter()
+        try:
+            self.go(**request)
+        except Exception as error:
+            return error, perf_counter() - started
+        return None, perf_counter() - started
+
+    def iter_body(self, chunk_size=65536):
+        """Returns a generator of chunks of the response body requested
+        with ``stream`` (see `go`). The content encoding is decoded
+        incrementally, so memory is bounded by ``chunk_size``.
+        """
+        stream = self.__stream
+        assert stream is not None
+        return self.read_stream(stream, self.content_decoder(), chunk_size)
+
+    def read_stream(self, stream, decoder, chunk_size):
+        r = stream[0]
+        completed = False
+        try:
+            while True:
+                chunk = r.read(chunk_size)
+                if not chunk:
+                    break
+                if decoder is not None:
+                    chunk = decoder.decompress(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if decoder is not None:
+                chunk = decoder.flush()
+                if chunk:
+                    yield chunk
+            completed = True
+        finally:
+            # the stream is ended already if another request was sent
+            if self.__stream is stream:
+                self.end_stream(completed)
+
+    def write_body(self, fileobj, chunk_size=65536):
+        """Writes the response body requested with ``stream`` to
+        ``fileobj`` and returns a number of bytes written.
+        """
+        size = 0
+        for chunk in self.iter_body(chunk_size):
+            fileobj.write(chunk)
+            size += len(chunk)
+        return size
+
+    def close_stream(self):
+        """Discards the rest of the response body requested with
+        ``stream`` and gives the connection back. The connection is
+        closed, since it can not be reused with the body not read.
+        """
+        if self.__stream is not None:
+            self.end_stream(False)
+
+    # region: internal details
+
+    def new_connection(self):
+        return make_connection(self.scheme, self.netloc, self.resolver)
+
+    def prepare(self, path, method, params, headers, content_type, body):
         headers = (
             headers
             and dict(self.default_headers, **headers)
@@ -129,48 +1130,668 @@ class HTTPClient(object):
             else:
                 body = urlencode(params, doseq=True)
                 headers["Content-Type"] = "application/x-www-form-urlencoded"
+        return path, body, headers
 
+    def lookup_cache(self, path, headers):
+        request = {name.lower(): value for name, value in headers.items()}
+        key = "%s://%s%s" % (self.scheme, self.netloc, path)
+        credentials = "%s\n%s" % (
+            request.get("authorization", ""),
+            request.get("cookie", ""),
+        )
+        if credentials != "\n":
+            # responses are never shared between users
+            key += "#" + sha1(credentials.encode("utf-8")).hexdigest()
+        entry = self.cache.get(key)
+        if entry is not None and not entry.matches(request):
+            entry = None
+        if entry is None:
+            # there is no body to replay on 304, e.g. the entry was
+            # evicted or the key changed with a cookie
+            headers.pop("If-None-Match", None)
+            request.pop("if-none-match", None)
+        elif entry.expires <= time():
+            entry.add_validators(headers)
+        return key, request, entry
+
+    def process_cache(self, key, request, path, entry, headers):
+        if self.status_code == 304 and entry is not None:
+            entry.expires = cache_expires(headers)
+            self.cache.set(key, entry)
+            self.replay(entry, path)
+        elif self.status_code == 200:
+            entry = CachedResponse.create(
+                self.status_code, headers, self.body, request
+            )
+            if entry is not None:
+                self.cache.set(key, entry)
+
+    def replay(self, entry, path):
+        self.process_response(entry.status, entry.headers, path, False)
+        self.body = entry.body
+
+    def reset(self):
         self.status_code = 0
         self.body = None
         self.__content = None
         self.__json = None
+        if self.__stream is not None:
+            self.end_stream(False)
+        self.timing = None
 
-        self.connection.connect()
-        self.connection.request(method, path, body, headers)
-        r = self.connection.getresponse()
-        self.body = r.read()
-        self.connection.close()
+    def process_response(self, status, headers, path, decode=True):
+        self.status_code = status
+        self.headers = HTTPHeaders(headers)
 
-        self.status_code = r.status
-        self.headers = defaultdict(list)
-        for name, value in r.getheaders():
-            self.headers[name].append(value)
-
-        self.process_content_encoding()
+        if decode:
+            self.process_content_encoding()
         self.process_etag(path)
         self.process_cookies()
-        return self.status_code
 
-    # region: internal details
+    def end_stream(self, completed):
+        r, connection = self.__stream
+        self.__stream = None
+        if not completed:
+            # the response is not read to the end, so the connection
+            # can not be reused
+            connection.close()
+        self.release(connection)
+        if self.timing is not None and completed:
+            self.process_timing()
+
+    def process_timing(self):
+        self.timing.complete = perf_counter() - self.timing.start
+        if self.on_timing is not None:
+            self.on_timing(self, self.timing)
+
+    def acquire(self):
+        if self.pool is None:
+            connection = self.connection
+            if self.timeout is not None:
+                set_timeout(connection, self.timeout)
+        else:
+            # a pooled connection may keep a timeout of another client
+            connection = self.pool.acquire(self.scheme, self.netloc)
+            set_timeout(connection, self.timeout)
+        return connection
+
+    def release(self, connection):
+        if self.pool is not None:
+            self.pool.get_back(self.scheme, self.netloc, connection)
+        elif not self.keep_alive:
+            connection.close()
+
+    def send(self, connection, method, path, body, headers, timing=None):
+        reused = self.keep_alive and connection.sock is not None
+        if not reused and (timing is not None or not self.keep_alive):
+            self.connect(connection, timing)
+        try:
+            try:
+                return self.request(
+                    connection, method, path, body, headers, timing
+                )
+            except ConnectionError:
+                # the server might have closed idle connection
+                if (
+                    not reused
+                    or method not in IDEMPOTENT_METHODS
+                    or not isinstance(body, (str, bytes))
+                ):
+                    raise
+                connection.close()
+            if timing is not None:
+                self.connect(connection, timing)
+            return self.request(
+                connection, method, path, body, headers, timing
+            )
+        except BaseException:
+            # the connection state is unknown, e.g. the request is sent
+            # but a response timed out, so it can not be reused
+            connection.close()
+            raise
+
+    def read(self, r, connection):
+        try:
+            return r.read()
+        except BaseException:
+            # the response is not read to the end, so the connection
+            # can not be reused
+            connection.close()
+            raise
+
+    def connect(self, connection, timing):
+        connection.connect()
+        if timing is not None:
+            timing.connect = perf_counter() - timing.start
+
+    def request(self, connection, method, path, body, headers, timing):
+        connection.request(method, path, body, headers)
+        if timing is None:
+            return connection.getresponse()
+        timing.sent = perf_counter() - timing.start
+        r = connection.getresponse()
+        timing.first_byte = perf_counter() - timing.start
+        return r
+
+    def content_decoder(self):
+        encodings = self.headers.get("content-encoding")
+        if not encodings:
+            return None
+        encoding = encodings[-1].strip().lower()
+        if encoding in ("gzip", "x-gzip", "deflate"):
+            return ContentDecoder(encoding, self.max_decoded_size)
+        return None
 
     def process_content_encoding(self):
-        if (
-            "content-encoding" in self.headers
-            and "gzip" in self.headers["content-encoding"]
-        ):
-            self.body = decompress(self.body)
+        decoder = self.content_decoder()
+        if decoder is not None:
+            self.body = decoder.decompress(self.body) + decoder.flush()
 
     def process_etag(self, path):
-        if "etag" in self.headers:
-            self.etags[path] = self.headers["etag"][-1]
+        etags = self.headers.get("etag")
+        if etags:
+            self.etags[path] = etags[-1]
 
     def process_cookies(self):
-        if "set-cookie" in self.headers:
-            for cookie_string in self.headers["set-cookie"]:
-                cookies = SimpleCookie(cookie_string)
-                for name in cookies:
-                    value = cookies[name].value
-                    if value:
-                        self.cookies[name] = value
-                    elif name in self.cookies:
-                        del self.cookies[name]
+        for cookie_string in self.headers.get("set-cookie", ()):
+            cookies = SimpleCookie(cookie_string)
+            for name in cookies:
+                value = cookies[name].value
+                if value:
+                    self.cookies[name] = value
+                elif name in self.cookies:
+                    del self.cookies[name]
+
+
+class AsyncHTTPConnectionPool(object):
+    """A pool of asyncio keep-alive HTTP connections shared by
+    `AsyncHTTPClient` instances. Connections are pooled per
+    (scheme, host, port) with at most *size* connections in use per
+    host; acquire waits until a connection is available.
+
+    A connection idle for longer than *idle_timeout* seconds is closed.
+    """
+
+    def __init__(self, size=10, idle_timeout=60.0):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.hosts = {}
+
+    def get_host(self, scheme, netloc):
+        """Returns a (semaphore, idle connections) pair for the host."""
+        parts = urlsplit("%s://%s" % (scheme, netloc))
+        key = (
+            scheme,
+            parts.hostname,
+            parts.port or (scheme == "http" and 80 or 443),
+        )
+        host = self.hosts.get(key)
+        if host is None:
+            self.hosts[key] = host = (Semaphore(self.size), [], key)
+        return host
+
+    async def acquire(self, scheme, netloc):
+        """Return a (reader, writer) connection to the host."""
+        semaphore, idle, key = self.get_host(scheme, netloc)
+        await semaphore.acquire()
+        try:
+            while idle:
+                reader, writer, last_used = idle.pop()
+                if (
+                    time() - last_used < self.idle_timeout
+                    and not reader.at_eof()
+                    and not writer.is_closing()
+                ):
+                    return reader, writer
+                writer.close()
+            return await open_connection(
+                key[1], key[2], ssl=scheme == "https" or None
+            )
+        except BaseException:
+            semaphore.release()
+            raise
+
+    def get_back(self, scheme, netloc, connection, reuse=True):
+        """Return the connection back to the pool, it is closed unless
+        *reuse* is true.
+        """
+        semaphore, idle, key = self.get_host(scheme, netloc)
+        reader, writer = connection
+        if reuse:
+            idle.append((reader, writer, time()))
+        else:
+            writer.close()
+        semaphore.release()
+
+
+class AsyncHTTPClient(HTTPClient):
+    """Asyncio HTTP client with the same API as `HTTPClient`, except
+    requests are coroutines, e.g. ``await client.get(path)``.
+
+    Connections are kept alive and taken from *pool*, a shared
+    `AsyncHTTPConnectionPool` that limits connections per host.
+    """
+
+    def __init__(
+        self,
+        url,
+        headers=None,
+        pool=None,
+        max_decoded_size=None,
+        timeout=None,
+    ):
+        super(AsyncHTTPClient, self).__init__(
+            url,
+            headers,
+            pool=pool or AsyncHTTPConnectionPool(),
+            max_decoded_size=max_decoded_size,
+            timeout=timeout,
+        )
+
+    async def go(
+        self,
+        path=None,
+        method="GET",
+        params=None,
+        headers=None,
+        content_type="",
+        body="",
+    ):
+        """Sends HTTP request to web server, see `HTTPClient.go`."""
+        self.method = method
+        path, body, headers = self.prepare(
+            path, method, params, headers, content_type, body
+        )
+        self.reset()
+        request = self.make_request(method, path, body, headers)
+        try:
+            status, headers, body = await wait_for(
+                self.send_request(method, request), self.timeout
+            )
+        except (ConnectionError, IncompleteReadError):
+            # the server might have closed idle connection
+            if method not in IDEMPOTENT_METHODS:
+                raise
+            status, headers, body = await wait_for(
+                self.send_request(method, request), self.timeout
+            )
+        self.body = body
+        self.process_response(status, headers, path)
+        return self.status_code
+
+    async def go_many(
+        self, requests, max_workers=4, timeout=None, deadline=None
+    ):
+        """Sends independent HTTP requests concurrently with at most
+        ``max_workers`` in flight, see `HTTPClient.go_many`.
+        """
+        clients = [self.clone(timeout) for _ in requests]
+        if not clients:
+            return clients
+        semaphore = Semaphore(max_workers)
+
+        async def go(client, request):
+            async with semaphore:
+                return await client.go_timed(request)
+
+        tasks = [
+            ensure_future(go(client, request))
+            for client, request in zip(clients, requests)
+        ]
+        done, pending = await wait(tasks, timeout=deadline)
+        for task in pending:
+            task.cancel()
+        for client, task in zip(clients, tasks):
+            if task in done:
+                client.error, client.elapsed = task.result()
+            else:
+                client.error = TimeoutError("deadline exceeded")
+                client.elapsed = None
+        return clients
+
+    async def go_timed(self, request):
+        started = perf_counter()
+        try:
+            await self.go(**request)
+        except Exception as error:
+            return error, perf_counter() - started
+        return None, perf_counter() - started
+
+    # region: internal details
+
+    def make_request(self, method, path, body, headers):
+        # validate as http.client does to prevent header injection
+        if RE_CONTROL_CHARS.search(method):
+            raise ValueError("method can't contain control characters")
+        if RE_CONTROL_CHARS.search(path):
+            raise InvalidURL("URL can't contain control characters")
+        if hasattr(body, "read"):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode("iso-8859-1")
+        lines = ["%s %s HTTP/1.1" % (method, path)]
+        names = format_headers(headers, lines)
+        if "host" not in names:
+            lines.insert(1, "Host: " + self.netloc)
+        if "content-length" not in names and (
+            body or method in ("POST", "PUT", "PATCH")
+        ):
+            lines.append("Content-Length: %d" % len(body))
+        lines.append("\r\n")
+        return "\r\n".join(lines).encode("iso-8859-1") + body
+
+    async def send_request(self, method, request):
+        connection = await self.pool.acquire(self.scheme, self.netloc)
+        reuse = False
+        try:
+            reader, writer = connection
+            writer.write(request)
+            await writer.drain()
+            status, headers, body, reuse = await read_response(reader, method)
+        finally:
+            self.pool.get_back(self.scheme, self.netloc, connection, reuse)
+        return status, headers, body
+
+
+def format_headers(headers, lines):
+    """Appends header lines to *lines* and returns a set of lower case
+    header names. Raises ``ValueError`` for a header name or value
+    that is not legal, e.g. contains CR or LF.
+
+    >>> lines = []
+    >>> sorted(format_headers({'Host': 'x', 'X-A': 1}, lines)), lines
+    (['host', 'x-a'], ['Host: x', 'X-A: 1'])
+    >>> format_headers({'X-A': 'a\\r\\nX-B: b'}, lines)
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid header value 'a\\r\\nX-B: b'
+    """
+    names = set()
+    for name, value in headers.items():
+        value = str(value)
+        if not RE_HEADER_NAME.fullmatch(name):
+            raise ValueError("invalid header name %r" % name)
+        if RE_ILLEGAL_HEADER_VALUE.search(value):
+            raise ValueError("invalid header value %r" % value)
+        names.add(name.lower())
+        lines.append("%s: %s" % (name, value))
+    return names
+
+
+async def read_response(reader, method):
+    """Reads HTTP/1.x response and returns status code, a list of
+    headers (names in lower case), body and whether the connection can
+    be reused.
+    """
+    line = await reader.readline()
+    if not line:
+        raise RemoteDisconnected("Remote end closed connection")
+    version, status = line.decode("iso-8859-1").split(None, 2)[:2]
+    status = int(status)
+    headers = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, value = line.decode("iso-8859-1").split(":", 1)
+        headers.append((name.strip().lower(), value.strip()))
+    info = dict(headers)
+    reuse = (
+        version == "HTTP/1.1" and info.get("connection", "").lower() != "close"
+    )
+    if method == "HEAD" or status in (204, 304) or status < 200:
+        body = b""
+    elif info.get("transfer-encoding", "").lower() == "chunked":
+        body = await read_chunked(reader)
+    elif "content-length" in info:
+        body = await reader.readexactly(int(info["content-length"]))
+    else:
+        body = await reader.read()
+        reuse = False
+    return status, headers, body, reuse
+
+
+async def read_chunked(reader):
+    chunks = []
+    while True:
+        line = await reader.readline()
+        size = int(line.split(b";", 1)[0], 16)
+        if not size:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readline()
+    # trailer
+    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+        pass
+    return b"".join(chunks)
+
+
+class LatencyHistogram(object):
+    """A latency histogram with HDR-style log-linear buckets: values
+    are recorded in microseconds with a relative error below
+    1 / 2 ** (*precision* - 1).
+
+    >>> h = LatencyHistogram()
+    >>> for ms in range(1, 101):
+    ...     h.record(ms / 1000.0)
+    >>> h.count, round(h.percentile(50), 3), round(h.percentile(99), 3)
+    (100, 0.05, 0.099)
+    """
+
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.counts = defaultdict(int)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        """Records a value in seconds."""
+        value = int(seconds * 1000000)
+        shift = value.bit_length() - self.precision
+        if shift > 0:
+            value = (value >> shift) << shift
+        self.counts[value] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other):
+        """Adds values recorded by other histogram."""
+        for value, n in other.counts.items():
+            self.counts[value] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Returns a value in seconds below which *p* percent of values
+        fall.
+        """
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100.0
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= threshold:
+                break
+        shift = value.bit_length() - self.precision
+        if shift > 0:
+            value += (1 << shift) >> 1
+        return min(value / 1000000.0, self.max)
+
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+
+class LoadStats(object):
+    """Results of `LoadTest`."""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.statuses = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.elapsed = 0.0
+
+    @property
+    def requests(self):
+        return self.latency.count
+
+    @property
+    def failures(self):
+        """Number of errors and responses with status 400 or above."""
+        return sum(self.errors.values()) + sum(
+            n for status, n in self.statuses.items() if status >= 400
+        )
+
+    def merge(self, other):
+        self.latency.merge(other.latency)
+        for status, n in other.statuses.items():
+            self.statuses[status] += n
+        for name, n in other.errors.items():
+            self.errors[name] += n
+
+    def report(self):
+        """Prints throughput, error rate and latency distribution."""
+        requests = self.requests
+        print(
+            "requests: %d in %.2fs, %.1frps"
+            % (requests, self.elapsed, requests / (self.elapsed or 1.0))
+        )
+        print(
+            "failures: %d (%.2f%%)"
+            % (self.failures, 100.0 * self.failures / (requests or 1))
+        )
+        for status in sorted(self.statuses):
+            print("  status %d: %d" % (status, self.statuses[status]))
+        for name in sorted(self.errors):
+            print("  %s: %d" % (name, self.errors[name]))
+        print("latency: mean %.2fms" % (self.latency.mean() * 1000))
+        for p in (50, 75, 90, 99, 99.9, 99.99, 100):
+            print("  %7s%% %10.2fms" % (p, self.latency.percentile(p) * 1000))
+
+
+class LoadTest(object):
+    """Sends requests with `HTTPClient` (see `HTTPClient.clone`) from
+    *concurrency* threads for *duration* seconds, cycling over
+    *paths*.
+
+    If *rate* (requests per second) is given, requests are scheduled
+    at a constant rate and latency is measured from the scheduled time,
+    so a stalled server is not hidden by fewer requests sent.
+    """
+
+    def __init__(
+        self,
+        client,
+        paths=None,
+        method="GET",
+        concurrency=1,
+        rate=None,
+        duration=10.0,
+    ):
+        self.client = client
+        self.paths = paths or [client.path]
+        self.method = method
+        self.concurrency = concurrency
+        self.rate = rate
+        self.duration = duration
+
+    def run(self):
+        """Runs the test and returns `LoadStats`."""
+        stats = LoadStats()
+        counter = count()
+        start = perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = [
+                executor.submit(self.worker, counter, start)
+                for _ in range(self.concurrency)
+            ]
+        for future in futures:
+            stats.merge(future.result())
+        stats.elapsed = perf_counter() - start
+        return stats
+
+    def worker(self, counter, start):
+        stats = LoadStats()
+        client = self.client.clone()
+        stop = start + self.duration
+        paths = self.paths
+        rate = self.rate
+        while True:
+            i = next(counter)
+            if rate:
+                scheduled = start + i / rate
+                delay = scheduled - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            else:
+                scheduled = perf_counter()
+            if scheduled >= stop:
+                break
+            try:
+                status = client.go(paths[i % len(paths)], self.method)
+            except Exception as error:
+                stats.errors[error.__class__.__name__] += 1
+            else:
+                stats.statuses[status] += 1
+            stats.latency.record(perf_counter() - scheduled)
+        return stats
+
+
+def main(args=None):
+    """Load test command line tool:
+
+    python -m wheezy.core.httpclient --help
+    """
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        prog="python -m wheezy.core.httpclient",
+        description="Sends HTTP requests and reports throughput, "
+        "failures and latency distribution.",
+    )
+    parser.add_argument("url", help="a base url")
+    parser.add_argument(
+        "-p",
+        "--path",
+        action="append",
+        help="a path relative to url, repeat to cycle over several",
+    )
+    parser.add_argument("-m", "--method", default="GET")
+    parser.add_argument(
+        "-H", "--header", action="append", default=[], help="name: value"
+    )
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    parser.add_argument("-r", "--rate", type=float, help="requests per second")
+    parser.add_argument(
+        "-d", "--duration", type=float, default=10.0, help="seconds"
+    )
+    parser.add_argument("-t", "--timeout", type=float, default=10.0)
+    options = parser.parse_args(args)
+    headers = dict(
+        (name.strip(), value.strip())
+        for name, value in (h.split(":", 1) for h in options.header)
+    )
+    client = HTTPClient(
+        options.url,
+        headers=headers,
+        pool=HTTPConnectionPool(size=options.concurrency),
+        timeout=options.timeout,
+    )
+    stats = LoadTest(
+        client,
+        options.path,
+        options.method,
+        options.concurrency,
+        options.rate,
+        options.duration,
+    ).run()
+    stats.report()
+    return stats.failures and 1 or 0
+
+
+if __name__ == "__main__":  # pragma: nocover
+    raise SystemExit(main())
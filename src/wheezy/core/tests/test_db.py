@@ -1,14 +1,35 @@
 import unittest
 import warnings
-from unittest.mock import Mock
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Event, Thread
+from unittest.mock import AsyncMock, Mock, call, patch
 
 from wheezy.core.db import (  # isort:skip
+    AsyncCursor,
+    AsyncSession,
+    AsyncTPCSession,
+    CachedSession,
     NullSession,
     NullTPCSession,
+    QueryCache,
+    InstrumentedCursor,
+    QueryStats,
+    ReplicaRouter,
+    RetryTransaction,
+    ROUTING_LEAST_OUTSTANDING,
+    RoutingSession,
     SESSION_STATUS_ACTIVE,
+    SESSION_STATUS_ENTERED,
+    SESSION_STATUS_IDLE,
     Session,
     TPCSession,
+    columnar_rows,
+    is_retryable_error,
+    record_rows,
+    tuple_rows,
 )
+from wheezy.core.retry import make_retry
 
 
 class SessionTestCase(unittest.TestCase):
@@ -89,6 +110,28 @@ class SessionTestCase(unittest.TestCase):
         self.session.cursor()
         assert self.mock_pool.acquire.call_count == 2
 
+    def test_commit_pinned(self):
+        """Pinned connection is kept across commits."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+
+        class MockSession(Session):
+            pass
+
+        session = MockSession(self.mock_pool, pinned=True)
+        session.on_active = Mock()
+        session.__enter__()
+        session.cursor()
+        session.commit()
+        session.cursor()
+        session.commit()
+        assert 2 == mock_connection.commit.call_count
+        self.mock_pool.acquire.assert_called_once_with()
+        session.on_active.assert_called_once_with(mock_connection)
+        assert not self.mock_pool.get_back.called
+        session.__exit__(None, None, None)
+        self.mock_pool.get_back.assert_called_once_with(mock_connection)
+
     def test_exit_on_unused(self):
         """Exit when connection was not used."""
         self.session.__enter__()
@@ -120,6 +163,720 @@ class SessionTestCase(unittest.TestCase):
         )
         self.mock_pool.get_back.assert_called_once_with(mock_connection)
 
+    def test_bulk_execute(self):
+        """Rows are passed to executemany in chunks."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        self.session.__enter__()
+        rows = ((i,) for i in range(5))
+        assert 5 == self.session.bulk_execute("sql", rows, batch_size=2)
+        assert [
+            call("sql", [(0,), (1,)]),
+            call("sql", [(2,), (3,)]),
+            call("sql", [(4,)]),
+        ] == mock_cursor.executemany.call_args_list
+        assert 3 == mock_cursor.close.call_count
+        assert not mock_connection.commit.called
+
+    def test_bulk_execute_empty(self):
+        """No connection is acquired if there are no rows."""
+        self.session.__enter__()
+        assert 0 == self.session.bulk_execute("sql", [])
+        assert not self.mock_pool.acquire.called
+
+    def test_bulk_execute_commit(self):
+        """Session is committed after each chunk."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        progress = Mock()
+        self.session.__enter__()
+        self.session.bulk_execute(
+            "sql", [(1,), (2,), (3,)], 2, commit=True, progress=progress
+        )
+        assert 2 == mock_connection.commit.call_count
+        assert 2 == self.mock_pool.get_back.call_count
+        assert [2, 3] == [c[0][0] for c in progress.call_args_list]
+
+    def test_bulk_execute_error(self):
+        """Cursor is closed if executemany fails."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.executemany.side_effect = KeyError()
+        self.session.__enter__()
+        self.assertRaises(
+            KeyError, lambda: self.session.bulk_execute("sql", [(1,)])
+        )
+        mock_cursor.close.assert_called_once_with()
+
+    def test_stream(self):
+        """Rows are fetched in batches, connection is returned to the
+        pool on exhaustion.
+        """
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.fetchmany.side_effect = [[1, 2], [3], []]
+        self.session.__enter__()
+        rows = self.session.stream("sql", (1,), 2, "report")
+        mock_connection.cursor.assert_called_once_with("report")
+        mock_cursor.execute.assert_called_once_with("sql", (1,))
+        assert [1, 2, 3] == list(rows)
+        mock_cursor.fetchmany.assert_called_with(2)
+        mock_cursor.close.assert_called_once_with()
+        mock_connection.rollback.assert_called_once_with()
+        self.mock_pool.get_back.assert_called_once_with(mock_connection)
+        assert SESSION_STATUS_ENTERED == self.session.status
+        self.session.__exit__(None, None, None)
+        assert 1 == self.mock_pool.get_back.call_count
+
+    def test_stream_eager(self):
+        """Arguments are checked and query executed on call."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.execute.side_effect = KeyError()
+        self.session.__enter__()
+        self.assertRaises(
+            AssertionError, lambda: self.session.stream("sql", None, 0)
+        )
+        self.assertRaises(KeyError, lambda: self.session.stream("sql"))
+        mock_cursor.close.assert_called_once_with()
+
+    def test_stream_close(self):
+        """Cursor is closed and connection returned to the pool when
+        generator is closed.
+        """
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.fetchmany.return_value = [1, 2]
+        self.session.__enter__()
+        rows = self.session.stream("sql")
+        assert 1 == next(rows)
+        assert not self.mock_pool.get_back.called
+        rows.close()
+        mock_cursor.execute.assert_called_once_with("sql")
+        mock_cursor.close.assert_called_once_with()
+        self.mock_pool.get_back.assert_called_once_with(mock_connection)
+        assert SESSION_STATUS_ENTERED == self.session.status
+
+    def test_stream_close_not_started(self):
+        """Connection is returned to the pool if generator is closed
+        before iteration.
+        """
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        self.session.__enter__()
+        self.session.stream("sql").close()
+        mock_connection.cursor.return_value.close.assert_called_once_with()
+        self.mock_pool.get_back.assert_called_once_with(mock_connection)
+
+    def test_stream_commit(self):
+        """Commit while iterating keeps the connection until the
+        stream ends.
+        """
+        log = []
+        mock_connection = Mock()
+        mock_connection.commit.side_effect = lambda: log.append("COMMIT")
+        self.mock_pool.acquire.return_value = mock_connection
+        self.mock_pool.get_back.side_effect = lambda c: log.append("BACK")
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.execute.side_effect = lambda sql, *args: log.append(sql)
+        mock_cursor.fetchmany.side_effect = lambda n: log.append("FETCH") or (
+            [1] if log.count("FETCH") < 3 else []
+        )
+        self.session.__enter__()
+        for row in self.session.stream("SELECT"):
+            self.session.cursor().execute("UPDATE %d" % row)
+            self.session.commit()
+            assert not self.mock_pool.get_back.called
+            assert SESSION_STATUS_ACTIVE == self.session.status
+        assert [
+            "SELECT",
+            "FETCH",
+            "UPDATE 1",
+            "COMMIT",
+            "FETCH",
+            "UPDATE 1",
+            "COMMIT",
+            "FETCH",
+            "BACK",
+        ] == log
+        self.session.__exit__(None, None, None)
+        assert 1 == self.mock_pool.acquire.call_count
+        assert 1 == self.mock_pool.get_back.call_count
+
+    def test_stream_nested(self):
+        """Connection is returned to the pool when the last stream
+        ends.
+        """
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        outer_cursor, inner_cursor = Mock(), Mock()
+        outer_cursor.fetchmany.side_effect = [[1], []]
+        inner_cursor.fetchmany.side_effect = [[2], []]
+        mock_connection.cursor.side_effect = [outer_cursor, inner_cursor]
+        self.session.__enter__()
+        outer = self.session.stream("sql")
+        inner = self.session.stream("sql")
+        assert [1] == list(outer)
+        assert not self.mock_pool.get_back.called
+        assert [2] == list(inner)
+        self.mock_pool.get_back.assert_called_once_with(mock_connection)
+
+    def test_stream_writes(self):
+        """Writes made while iterating are committed."""
+        log = []
+        mock_connection = Mock()
+        mock_connection.commit.side_effect = lambda: log.append("COMMIT")
+        mock_connection.rollback.side_effect = lambda: log.append("ROLLBACK")
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.execute.side_effect = lambda sql, *args: log.append(sql)
+        mock_cursor.fetchmany.side_effect = [[1, 2], []]
+        self.session.__enter__()
+        for row in self.session.stream("SELECT"):
+            self.session.cursor().execute("UPDATE %d" % row)
+        self.session.commit()
+        self.session.__exit__(None, None, None)
+        assert ["SELECT", "UPDATE 1", "UPDATE 2", "COMMIT"] == log
+        assert 1 == self.mock_pool.acquire.call_count
+
+    def test_stream_pinned(self):
+        """Connection is kept if the session is pinned."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.fetchmany.side_effect = [[1], []]
+        session = Session(self.mock_pool, pinned=True)
+        session.__enter__()
+        assert [1] == list(session.stream("sql"))
+        assert not self.mock_pool.get_back.called
+
+    def test_fetchall(self):
+        """Rows are built by factory from cursor description."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.description = (("id",), ("name",))
+        mock_cursor.fetchall.return_value = [(1, "x")]
+        self.session.__enter__()
+        assert [(1, "x")] == self.session.fetchall("sql", (1,))
+        mock_cursor.execute.assert_called_once_with("sql", (1,))
+        rows = self.session.fetchall("sql", factory=record_rows)
+        mock_cursor.execute.assert_called_with("sql")
+        assert "x" == rows[0].name
+        assert {"id": [1], "name": ["x"]} == self.session.fetchall(
+            "sql", factory=columnar_rows
+        )
+        assert 3 == mock_cursor.close.call_count
+
+    def test_savepoint(self):
+        """Savepoint is released if the scope completes."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        self.assertRaises(AssertionError, self.session.savepoint)
+        self.session.__enter__()
+        with self.session.savepoint() as sp:
+            assert "sp1" == sp.name
+        with self.session.savepoint("x"):
+            with self.session.savepoint():
+                pass
+        assert [
+            call("SAVEPOINT sp1"),
+            call("RELEASE SAVEPOINT sp1"),
+            call("SAVEPOINT x"),
+            call("SAVEPOINT sp2"),
+            call("RELEASE SAVEPOINT sp2"),
+            call("RELEASE SAVEPOINT x"),
+        ] == mock_cursor.execute.call_args_list
+        assert 6 == mock_cursor.close.call_count
+
+    def test_savepoint_rollback(self):
+        """Scope is rolled back to savepoint on error."""
+        mock_connection = Mock()
+        self.mock_pool.acquire.return_value = mock_connection
+        mock_cursor = mock_connection.cursor.return_value
+        self.session.__enter__()
+
+        def f():
+            with self.session.savepoint():
+                raise KeyError()
+
+        self.assertRaises(KeyError, f)
+        mock_cursor.execute.assert_called_with("ROLLBACK TO SAVEPOINT sp1")
+        assert not mock_connection.rollback.called
+        self.session.__exit__(None, None, None)
+        self.session.__enter__()
+        assert "sp1" == self.session.savepoint().name
+
+    def test_stats(self):
+        """Acquire time is recorded and cursor is instrumented."""
+        stats = QueryStats()
+        session = Session(self.mock_pool, stats)
+        session.__enter__()
+        cursor = session.cursor()
+        assert isinstance(cursor, InstrumentedCursor)
+        assert 1 == stats.acquire_count
+
+
+class QueryStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.slow_query = Mock()
+        self.stats = QueryStats(self.slow_query, slow_threshold=1.0)
+
+    def test_record(self):
+        """Statements are accounted by normalized SQL."""
+        self.stats.record("SELECT 1", 0.5)
+        self.stats.record("SELECT  2", 1.5)
+        self.stats.record_rows("SELECT 3", 4)
+        s = self.stats.statements["SELECT ?"]
+        assert 2 == s.count
+        assert 2.0 == s.total
+        assert 1.5 == s.max
+        assert 1.0 == s.average
+        assert 4 == s.rows
+        self.slow_query.assert_called_once_with("SELECT  2", 1.5)
+
+    def test_record_rows_unknown(self):
+        """Rows of not executed statement are ignored."""
+        self.stats.record_rows("SELECT 1", 1)
+        assert not self.stats.statements
+
+    def test_top(self):
+        """Top statements are ordered by key."""
+        self.stats.record("a", 0.1)
+        self.stats.record("b", 0.3)
+        self.stats.record("a", 0.1)
+        assert ["b"] == [sql for sql, s in self.stats.top(1)]
+        assert ["a", "b"] == [sql for sql, s in self.stats.top(2, "count")]
+        assert 0.5 == round(self.stats.execute_time, 3)
+
+    @patch("builtins.print")
+    def test_report(self, mock_print):
+        """Report prints top statements."""
+        self.stats.record_acquire(0.2)
+        self.stats.record("a", 0.1)
+        self.stats.report()
+        assert 3 == mock_print.call_count
+
+
+class InstrumentedCursorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_cursor = Mock()
+        self.stats = QueryStats()
+        self.cursor = InstrumentedCursor(self.mock_cursor, self.stats)
+
+    def test_execute(self):
+        """Execution time and rows are recorded."""
+        self.mock_cursor.fetchall.return_value = [1, 2]
+        self.mock_cursor.fetchmany.return_value = [3]
+        self.mock_cursor.fetchone.side_effect = [4, None]
+        self.cursor.execute("sql", (1,))
+        self.mock_cursor.execute.assert_called_once_with("sql", (1,))
+        assert [1, 2] == self.cursor.fetchall()
+        assert [3] == self.cursor.fetchmany(10)
+        assert 4 == self.cursor.fetchone()
+        assert self.cursor.fetchone() is None
+        s = self.stats.statements["sql"]
+        assert 1 == s.count
+        assert 4 == s.rows
+
+    @patch("wheezy.core.db.perf_counter")
+    def test_execute_time(self, mock_perf_counter):
+        """Execution time is measured with a monotonic clock."""
+        mock_perf_counter.side_effect = [10.0, 10.5, 20.0, 20.25]
+        self.cursor.execute("sql")
+        self.cursor.executemany("sql", [(1,)])
+        assert 0.75 == self.stats.statements["sql"].total
+
+    def test_execute_error(self):
+        """Failed execution is recorded."""
+        self.mock_cursor.executemany.side_effect = KeyError()
+        self.assertRaises(
+            KeyError, lambda: self.cursor.executemany("sql", [(1,)])
+        )
+        assert 1 == self.stats.statements["sql"].count
+
+    def test_iter(self):
+        """Rows iterated are recorded."""
+        self.mock_cursor.__iter__ = Mock(return_value=iter([1, 2]))
+        self.cursor.execute("sql")
+        assert [1, 2] == list(self.cursor)
+        assert 2 == self.stats.statements["sql"].rows
+
+    def test_delegate(self):
+        """Other attributes are delegated to cursor."""
+        with self.cursor as c:
+            assert self.mock_cursor.rowcount == c.rowcount
+        self.mock_cursor.close.assert_called_once_with()
+
+
+class ReplicaRouterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pools = [Mock(), Mock()]
+        for pool in self.pools:
+            pool.acquire.side_effect = lambda: Mock()
+
+    def test_round_robin(self):
+        """Pools are selected in turn."""
+        router = ReplicaRouter(self.pools)
+        assert [0, 1, 0] == [router.select() for _ in range(3)]
+        assert [2, 1] == router.outstanding
+
+    def test_least_outstanding(self):
+        """A pool with least outstanding connections is selected."""
+        router = ReplicaRouter(self.pools, ROUTING_LEAST_OUTSTANDING)
+        c = router.acquire()
+        assert [1, 0] == router.outstanding
+        assert 1 == router.select()
+        router.get_back(c)
+        assert 0 == router.select()
+
+    def test_acquire_get_back(self):
+        """Connection is returned to the pool it came from."""
+        router = ReplicaRouter(self.pools)
+        c1 = router.acquire()
+        c2 = router.acquire()
+        router.get_back(c2)
+        router.get_back(c1)
+        self.pools[0].get_back.assert_called_once_with(c1)
+        self.pools[1].get_back.assert_called_once_with(c2)
+        assert [0, 0] == router.outstanding
+        assert not router.acquired
+
+    def test_acquire_error(self):
+        """Outstanding count is restored if acquire fails."""
+        self.pools[0].acquire.side_effect = KeyError()
+        router = ReplicaRouter(self.pools)
+        self.assertRaises(KeyError, router.acquire)
+        assert [0, 0] == router.outstanding
+
+    def test_skip_slow(self):
+        """Slow pools are skipped until their latency fades."""
+        router = ReplicaRouter(self.pools, max_latency=1.0, decay=0.5)
+        router.latency[0] = 3.0
+        assert 1 == router.select()
+        assert 1.5 == router.latency[0]
+        assert 1 == router.select()
+        assert 0.75 == router.latency[0]
+        assert 0 == router.select()
+
+    def test_all_slow(self):
+        """All pools are used if all of them are slow."""
+        router = ReplicaRouter(self.pools, max_latency=1.0)
+        router.latency[:] = [5.0, 5.0]
+        assert [0, 1] == [router.select() for _ in range(2)]
+
+    @patch("wheezy.core.db.perf_counter")
+    def test_latency(self, mock_perf_counter):
+        """Latency is a moving average of the pool acquire time, not
+        the connection hold time.
+        """
+        router = ReplicaRouter(self.pools, decay=0.5)
+        mock_perf_counter.side_effect = [10.0, 12.0]
+        c = router.acquire()
+        assert [1.0, 0.0] == router.latency
+        router.get_back(c)
+        assert [1.0, 0.0] == router.latency
+        assert 2 == mock_perf_counter.call_count
+
+
+class RoutingSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_pool = Mock()
+        self.mock_router = Mock()
+        self.session = RoutingSession(self.mock_pool, self.mock_router)
+
+    def test_enter(self):
+        """Enter returns session instance."""
+        assert self.session == self.session.__enter__()
+        assert SESSION_STATUS_ENTERED == self.session.status
+
+    def test_read_cursor(self):
+        """Reads are routed to a replica."""
+        self.session.__enter__()
+        self.session.read_cursor()
+        assert self.mock_router.acquire.called
+        assert not self.mock_pool.acquire.called
+        assert SESSION_STATUS_ACTIVE == self.session.status
+        self.session.commit()
+        assert self.mock_router.get_back.called
+
+    def test_pinned(self):
+        """After a write reads are sent to the primary."""
+        self.session.__enter__()
+        replica = self.mock_router.acquire.return_value
+        self.session.read_cursor()
+        primary = self.mock_pool.acquire.return_value
+        self.session.cursor()
+        self.mock_router.get_back.assert_called_once_with(replica)
+        self.session.read_cursor()
+        assert 1 == self.mock_router.acquire.call_count
+        assert 2 == primary.cursor.call_count
+        self.session.commit()
+        self.session.read_cursor()
+        assert 1 == self.mock_router.acquire.call_count
+        self.session.__exit__(None, None, None)
+        assert not self.session.pinned
+
+    def test_connection(self):
+        """Connection is the primary one."""
+        self.session.__enter__()
+        assert self.mock_pool.acquire.return_value == self.session.connection
+        assert self.session.pinned
+
+    def test_commit_on_unused(self):
+        """Nothing is acquired on commit."""
+        self.assertRaises(AssertionError, self.session.commit)
+        self.session.__enter__()
+        self.session.commit()
+        assert not self.mock_pool.acquire.called
+        assert not self.mock_router.acquire.called
+
+    def test_exit(self):
+        """Both connections are rolled back and returned."""
+        self.session.__enter__()
+        self.session.read_cursor()
+        self.session.__exit__(None, None, None)
+        replica = self.mock_router.acquire.return_value
+        replica.rollback.assert_called_once_with()
+        self.mock_router.get_back.assert_called_once_with(replica)
+
+
+class QueryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = QueryCache(maxsize=2, ttl=10)
+
+    def test_get_set(self):
+        """Cached values are returned until evicted."""
+        assert self.cache.get("a") is None
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        assert 1 == self.cache.get("a")
+        self.cache.set("c", 3)
+        assert self.cache.get("b") is None
+        assert 1 == self.cache.get("a")
+        assert 3 == self.cache.get("c")
+        assert 3 == self.cache.hits
+        assert 2 == self.cache.misses
+
+    @patch("wheezy.core.db.time")
+    def test_expired(self, mock_time):
+        """Expired values are removed."""
+        mock_time.return_value = 100.0
+        self.cache.set("a", 1, tags=("t",), ttl=5)
+        mock_time.return_value = 105.0
+        assert self.cache.get("a") is None
+        assert not self.cache.items
+        assert not self.cache.tags
+
+    def test_invalidate(self):
+        """Entries tagged are removed."""
+        self.cache.set("a", 1, tags=("t1", "t2"))
+        self.cache.set("b", 2, tags=("t2",))
+        self.cache.invalidate("t1", "x")
+        assert self.cache.get("a") is None
+        assert 2 == self.cache.get("b")
+        self.cache.set("b", 3, tags=("t2",))
+        self.cache.invalidate("t2")
+        assert not self.cache.items
+        assert not self.cache.tags
+
+    def test_get_or_load(self):
+        """Value is loaded once."""
+        load = Mock(return_value=[1])
+        assert [1] == self.cache.get_or_load("a", load, ("t",))
+        assert [1] == self.cache.get_or_load("a", load, ("t",))
+        load.assert_called_once_with()
+        assert not self.cache.loading
+
+    def test_get_or_load_invalidated(self):
+        """Value is not cached if invalidated while loading."""
+
+        def load():
+            self.cache.invalidate("t")
+            return 1
+
+        assert 1 == self.cache.get_or_load("a", load, ("t",))
+        assert self.cache.get("a") is None
+
+    def test_get_or_load_other_invalidated(self):
+        """Value is cached if other tag is invalidated while loading."""
+
+        def load():
+            self.cache.invalidate("x")
+            return 1
+
+        assert 1 == self.cache.get_or_load("a", load, ("t",))
+        assert 1 == self.cache.get("a")
+
+    def test_get_or_load_error(self):
+        """Loading state is cleared on error."""
+        load = Mock(side_effect=KeyError())
+        self.assertRaises(KeyError, lambda: self.cache.get_or_load("a", load))
+        assert not self.cache.loading
+        cache = QueryCache(single_flight=False)
+        self.assertRaises(KeyError, lambda: cache.get_or_load("a", load))
+
+    def test_single_flight(self):
+        """Concurrent misses wait for a single load."""
+        started = Event()
+        release = Event()
+        load = Mock(side_effect=lambda: started.set() or release.wait())
+        results = []
+        threads = [
+            Thread(
+                target=lambda: results.append(
+                    self.cache.get_or_load("a", load)
+                )
+            )
+            for _ in range(3)
+        ]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        load.assert_called_once_with()
+        assert [True] * 3 == results
+
+
+class CachedSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_session = Mock()
+        self.mock_session.__enter__ = Mock()
+        self.mock_session.__exit__ = Mock()
+        self.mock_cursor = self.mock_session.cursor.return_value
+        self.mock_cursor.fetchall.return_value = [(1,)]
+        self.mock_session.fetchall.side_effect = partial(
+            Session.fetchall, self.mock_session
+        )
+        self.cache = QueryCache()
+        self.session = CachedSession(self.mock_session, self.cache)
+
+    def test_fetchall(self):
+        """Reads with tags are cached."""
+        with self.session as session:
+            assert [(1,)] == session.fetchall("sql", [1], tags=("t",))
+            assert [(1,)] == session.fetchall("sql", [1], tags=("t",))
+            session.fetchall("sql")
+        assert 2 == self.mock_cursor.execute.call_count
+        self.mock_cursor.execute.assert_called_with("sql")
+        assert 2 == self.mock_cursor.close.call_count
+
+    def test_fetchall_factory(self):
+        """Results are cached per factory."""
+        self.mock_cursor.description = (("id",),)
+        self.session.__enter__()
+        rows = self.session.fetchall("sql", tags=("t",), factory=tuple_rows)
+        assert [(1,)] == rows
+        rows.append((2,))
+        assert [(1,)] == self.session.fetchall(
+            "sql", tags=("t",), factory=tuple_rows
+        )
+        columns = self.session.fetchall(
+            "sql", tags=("t",), factory=columnar_rows
+        )
+        assert {"id": [1]} == columns
+        columns["id"].append(2)
+        assert {"id": [1]} == self.session.fetchall(
+            "sql", tags=("t",), factory=columnar_rows
+        )
+        assert 2 == self.mock_cursor.execute.call_count
+        self.mock_session.fetchall.assert_called_with(
+            "sql", None, columnar_rows
+        )
+
+    def test_touch_commit(self):
+        """Touched tables bypass cache and are invalidated on commit."""
+        self.session.__enter__()
+        self.session.fetchall("sql", tags=("t",))
+        self.session.touch("t")
+        self.session.fetchall("sql", tags=("t",))
+        assert 2 == self.mock_cursor.execute.call_count
+        assert self.cache.items
+        self.session.commit()
+        assert not self.cache.items
+        assert not self.session.touched
+        self.mock_session.commit.assert_called_once_with()
+
+    def test_exit(self):
+        """Touched tables are discarded on exit."""
+        self.session.__enter__()
+        assert self.mock_session.status == self.session.status
+        assert self.mock_session.connection == self.session.connection
+        self.session.cursor(1)
+        self.mock_session.cursor.assert_called_once_with(1)
+        self.session.touch("t")
+        self.session.__exit__(None, None, None)
+        assert not self.session.touched
+        self.mock_session.__exit__.assert_called_once_with(None, None, None)
+
+
+class RetryError(Exception):
+    pgcode = "40P01"
+
+
+class RetryTransactionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.mock_session = Mock()
+        self.mock_session.__enter__ = Mock(return_value=self.mock_session)
+        self.mock_session.__exit__ = Mock(return_value=False)
+        self.on_retry = Mock()
+        self.transaction = RetryTransaction(
+            lambda: self.mock_session,
+            make_retry(timeout=1.0, start=0.001),
+            on_retry=self.on_retry,
+        )
+
+    def test_is_retryable_error(self):
+        """Errors are classified by SQLSTATE or error number."""
+        assert is_retryable_error(RetryError())
+        e = Exception()
+        e.sqlstate = "40001"
+        assert is_retryable_error(e)
+        e.sqlstate = "23505"
+        assert not is_retryable_error(e)
+        assert is_retryable_error(Exception(1213, "Deadlock found"))
+        assert not is_retryable_error(Exception(1062, "Duplicate entry"))
+        assert not is_retryable_error(Exception())
+
+    def test_succeeded(self):
+        """Work result is returned and session committed."""
+        assert 1 == self.transaction(lambda session: 1)
+        self.mock_session.commit.assert_called_once_with()
+        assert 1 == self.transaction.calls
+        assert 0 == self.transaction.retries
+
+    def test_retry(self):
+        """Work is retried on retryable error."""
+        work = Mock(side_effect=[RetryError(), RetryError(), 2])
+        assert 2 == self.transaction(work)
+        assert 3 == work.call_count
+        assert 2 == self.transaction.retries
+        assert [1, 2] == [c[0][1] for c in self.on_retry.call_args_list]
+        assert 0 == self.transaction.failures
+
+    def test_not_retryable(self):
+        """Other errors are raised immediately."""
+        work = Mock(side_effect=KeyError())
+        self.assertRaises(KeyError, lambda: self.transaction(work))
+        work.assert_called_once_with(self.mock_session)
+        assert 1 == self.transaction.calls
+
+    def test_timeout(self):
+        """The last error is raised if retry gave up."""
+        self.transaction.retry = lambda acquire: acquire() and False
+        work = Mock(side_effect=RetryError())
+        self.assertRaises(RetryError, lambda: self.transaction(work))
+        assert 1 == self.transaction.failures
+
 
 class TPCSessionTestCase(unittest.TestCase):
     def setUp(self):
@@ -210,6 +967,41 @@ class TPCSessionTestCase(unittest.TestCase):
         session.connection.tpc_commit.assert_called_once_with()
         session.__exit__.assert_called_once_with(None, None, None)
 
+    def test_commit_executor(self):
+        """Phases run concurrently with executor."""
+        with ThreadPoolExecutor(2) as executor:
+            session = TPCSession(executor=executor)
+            session.__enter__()
+            sessions = [Mock(), Mock()]
+            for s in sessions:
+                s.__enter__ = Mock()
+                s.__exit__ = Mock()
+                s.status = SESSION_STATUS_ACTIVE
+                session.enlist(s)
+            session.commit()
+        for s in sessions:
+            s.connection.tpc_prepare.assert_called_once_with()
+            s.connection.tpc_commit.assert_called_once_with()
+            s.__exit__.assert_called_once_with(None, None, None)
+
+    def test_commit_executor_prepare_error(self):
+        """All participants are prepared even if one fails."""
+        with ThreadPoolExecutor(2) as executor:
+            session = TPCSession(executor=executor)
+            session.__enter__()
+            sessions = [Mock(), Mock()]
+            for s in sessions:
+                s.__enter__ = Mock()
+                s.__exit__ = Mock()
+                s.status = SESSION_STATUS_ACTIVE
+                session.enlist(s)
+            sessions[0].connection.tpc_prepare.side_effect = KeyError()
+            self.assertRaises(KeyError, session.commit)
+        for s in sessions:
+            s.connection.tpc_prepare.assert_called_once_with()
+            assert not s.connection.tpc_commit.called
+            assert not s.__exit__.called
+
     def test_exit_on_unused(self):
         """No sessions enlisted."""
         self.session.__enter__()
@@ -256,6 +1048,138 @@ class TPCSessionTestCase(unittest.TestCase):
         warnings.simplefilter("default")
 
 
+class AsyncSessionTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.mock_pool = AsyncMock()
+        self.mock_connection = AsyncMock()
+        self.mock_pool.acquire.return_value = self.mock_connection
+        self.session = AsyncSession(self.mock_pool)
+
+    async def test_enter(self):
+        """Enter returns session instance."""
+        async with self.session as session:
+            assert self.session == session
+            assert SESSION_STATUS_ENTERED == session.status
+
+    async def test_connection_raise_error(self):
+        """If not entered raise error."""
+        with self.assertRaises(AssertionError):
+            await self.session.connection()
+
+    async def test_connection(self):
+        """Ensure same connection is returned each time."""
+        await self.session.__aenter__()
+        assert self.mock_connection == await self.session.connection()
+        assert self.mock_connection == await self.session.connection()
+        self.mock_pool.acquire.assert_awaited_once_with()
+        assert SESSION_STATUS_ACTIVE == self.session.status
+
+    async def test_cursor(self):
+        """Ensure cursor is called with all args."""
+        await self.session.__aenter__()
+        cursor = await self.session.cursor(1, x=2)
+        self.mock_connection.cursor.assert_awaited_once_with(1, x=2)
+        assert self.mock_connection.cursor.return_value == cursor
+
+    async def test_commit(self):
+        """Connection is committed and returned to the pool."""
+        await self.session.__aenter__()
+        await self.session.commit()
+        assert not self.mock_pool.acquire.called
+        await self.session.cursor()
+        await self.session.commit()
+        self.mock_connection.commit.assert_awaited_once_with()
+        self.mock_pool.get_back.assert_awaited_once_with(self.mock_connection)
+        assert SESSION_STATUS_ENTERED == self.session.status
+
+    async def test_exit_rollback(self):
+        """Exit when no commit called."""
+        async with self.session:
+            await self.session.cursor()
+        self.mock_connection.rollback.assert_awaited_once_with()
+        self.mock_pool.get_back.assert_awaited_once_with(self.mock_connection)
+
+    async def test_blocking(self):
+        """Blocking calls are offloaded to executor."""
+        mock_pool = Mock()
+        mock_connection = mock_pool.acquire.return_value
+        mock_cursor = mock_connection.cursor.return_value
+        mock_cursor.fetchall.return_value = [1]
+        async with AsyncSession(mock_pool, blocking=True) as session:
+            cursor = await session.cursor()
+            assert isinstance(cursor, AsyncCursor)
+            await cursor.execute("sql", (1,))
+            await cursor.executemany("sql", [(1,)])
+            await cursor.fetchone()
+            await cursor.fetchmany(10)
+            assert [1] == await cursor.fetchall()
+            await cursor.close()
+            assert mock_cursor.rowcount == cursor.rowcount
+            await session.commit()
+        mock_cursor.execute.assert_called_once_with("sql", (1,))
+        mock_cursor.fetchmany.assert_called_once_with(10)
+        mock_connection.commit.assert_called_once_with()
+        mock_pool.get_back.assert_called_once_with(mock_connection)
+
+
+class AsyncTPCSessionTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.session = AsyncTPCSession()
+
+    def enlisted(self):
+        mock_pool = Mock()
+        session = AsyncSession(mock_pool)
+        return session, mock_pool.acquire.return_value
+
+    async def test_enlist_raise_error(self):
+        """If not entered raise error."""
+        with self.assertRaises(AssertionError):
+            await self.session.enlist(None)
+
+    async def test_commit(self):
+        """Enlisted sessions are prepared, committed and exited."""
+        async with self.session:
+            await self.session.commit()
+            s1, c1 = self.enlisted()
+            s2, c2 = self.enlisted()
+            await self.session.enlist(s1)
+            await self.session.enlist(s2)
+            await self.session.commit()
+        for s, c in ((s1, c1), (s2, c2)):
+            c.tpc_begin.assert_called_once_with(c.xid.return_value)
+            c.tpc_prepare.assert_called_once_with()
+            c.tpc_commit.assert_called_once_with()
+            s.pool.get_back.assert_called_once_with(c)
+            assert SESSION_STATUS_IDLE == s.status
+
+    async def test_commit_prepare_error(self):
+        """All participants are prepared and rolled back on error."""
+        async with self.session:
+            s1, c1 = self.enlisted()
+            s2, c2 = self.enlisted()
+            await self.session.enlist(s1)
+            await self.session.enlist(s2)
+            c1.tpc_prepare.side_effect = KeyError()
+            with self.assertRaises(KeyError):
+                await self.session.commit()
+            c2.tpc_prepare.assert_called_once_with()
+            assert not c2.tpc_commit.called
+        c1.tpc_rollback.assert_called_once_with()
+        c2.tpc_rollback.assert_called_once_with()
+
+    async def test_exit_rollback_error(self):
+        """A warning is issued if rollback fails."""
+        await self.session.__aenter__()
+        s, c = self.enlisted()
+        await self.session.enlist(s)
+        c.tpc_rollback.side_effect = KeyError()
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            await self.session.__aexit__(None, None, None)
+        c.rollback.assert_called_once_with()
+        assert SESSION_STATUS_IDLE == s.status
+
+
 class NullSessionTestCase(unittest.TestCase):
     def setUp(self):
         self.session = NullSession()
@@ -286,6 +1210,33 @@ class NullSessionTestCase(unittest.TestCase):
         self.session.__enter__()
         self.session.commit()
 
+    def test_bulk_execute(self):
+        """Rows are consumed and counted."""
+        self.assertRaises(
+            AssertionError, lambda: self.session.bulk_execute("sql", [])
+        )
+        self.session.__enter__()
+        assert 2 == self.session.bulk_execute("sql", iter([(1,), (2,)]))
+
+    def test_fetchall(self):
+        """Result is empty."""
+        self.assertRaises(AssertionError, lambda: self.session.fetchall(""))
+        self.session.__enter__()
+        assert [] == self.session.fetchall("sql")
+
+    def test_savepoint(self):
+        """Savepoint is noop."""
+        self.assertRaises(AssertionError, self.session.savepoint)
+        self.session.__enter__()
+        with self.session.savepoint():
+            pass
+
+    def test_stream(self):
+        """Stream is empty."""
+        self.assertRaises(AssertionError, lambda: self.session.stream("sql"))
+        self.session.__enter__()
+        assert [] == list(self.session.stream("sql"))
+
     def test_exit_raise_error(self):
         """If session is not entered raise error."""
         self.assertRaises(
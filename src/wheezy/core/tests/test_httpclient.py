@@ -1,8 +1,27 @@
+import asyncio
+import json
+import os
 import unittest
+import zlib
+from contextlib import redirect_stdout
+from http.client import InvalidURL, RemoteDisconnected
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from socket import (
+    AF_INET,
+    SOCK_STREAM,
+    _GLOBAL_DEFAULT_TIMEOUT,
+    create_server,
+    gaierror,
+    getdefaulttimeout,
+)
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
 from unittest.mock import Mock, patch
 
 from wheezy.core import __version__, httpclient
-from wheezy.core.gzip import compress
+from wheezy.core.collections import first_item_adapter
+from wheezy.core.gzip import compress, decompress
 
 
 class HTTPClientTestCase(unittest.TestCase):
@@ -44,6 +63,125 @@ class HTTPClientTestCase(unittest.TestCase):
         assert "close" == headers["Connection"]
         assert 3 == len(headers)
 
+    def test_keep_alive(self):
+        """Connection is reused."""
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", keep_alive=True
+        )
+        client.get("auth/token")
+        client.get("auth/token")
+        assert not self.mock_c.connect.called
+        assert not self.mock_c.close.called
+        assert 2 == self.mock_c.request.call_count
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert "keep-alive" == headers["Connection"]
+
+    def test_keep_alive_reconnect(self):
+        """Idempotent request is retried once if server closed
+        connection.
+        """
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", keep_alive=True
+        )
+        self.mock_response.status = 200
+        self.mock_c.getresponse.side_effect = [
+            RemoteDisconnected(),
+            self.mock_response,
+        ]
+        assert 200 == client.get("auth/token")
+        self.mock_c.close.assert_called_once_with()
+        assert 2 == self.mock_c.request.call_count
+
+    def test_keep_alive_no_retry(self):
+        """Not idempotent or not reused requests are not retried."""
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", keep_alive=True
+        )
+        self.mock_c.getresponse.side_effect = ConnectionResetError()
+        self.assertRaises(
+            ConnectionResetError, lambda: client.post("auth/token")
+        )
+        self.mock_c.sock = None
+        self.assertRaises(
+            ConnectionResetError, lambda: client.get("auth/token")
+        )
+        assert 2 == self.mock_c.request.call_count
+
+    def test_keep_alive_error(self):
+        """Connection is closed on any error, so it is not reused in
+        unknown state.
+        """
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", keep_alive=True
+        )
+        self.mock_c.getresponse.side_effect = [
+            TimeoutError(),
+            self.mock_response,
+        ]
+        self.assertRaises(TimeoutError, lambda: client.get("auth/token"))
+        self.mock_c.close.assert_called_once_with()
+        self.mock_response.status = 200
+        assert 200 == client.get("auth/token")
+
+    def test_pool(self):
+        """Connections are acquired from the shared pool."""
+        self.mock_c_class.reset_mock()
+        pool = httpclient.HTTPConnectionPool(size=2)
+        c1 = httpclient.HTTPClient("http://localhost/api/", pool=pool)
+        c2 = httpclient.HTTPClient("http://localhost:80/", pool=pool)
+        assert c1.keep_alive
+        c1.get("a")
+        c2.get("b")
+        self.mock_c_class.assert_called_once_with("localhost")
+        assert 1 == len(pool.pools)
+        assert not self.mock_c.close.called
+        assert 2 == pool.get_pool("http", "localhost").count
+
+    def test_pool_error(self):
+        """Connection is closed and returned to the pool on error."""
+        pool = httpclient.HTTPConnectionPool(size=1)
+        client = httpclient.HTTPClient("http://localhost/", pool=pool)
+        self.mock_c.getresponse.side_effect = KeyError()
+        self.assertRaises(KeyError, lambda: client.post("a"))
+        self.mock_c.close.assert_called_with()
+        assert 1 == pool.get_pool("http", "localhost").count
+
+    def test_pool_timeout(self):
+        """Client timeout is not inherited through the pool."""
+        pool = httpclient.HTTPConnectionPool(size=1)
+        c1 = httpclient.HTTPClient("http://localhost/", pool=pool, timeout=5)
+        c2 = httpclient.HTTPClient("http://localhost/", pool=pool)
+        c1.get("a")
+        assert 5 == self.mock_c.timeout
+        self.mock_c.sock.settimeout.assert_called_with(5)
+        c2.get("b")
+        assert _GLOBAL_DEFAULT_TIMEOUT is self.mock_c.timeout
+        self.mock_c.sock.settimeout.assert_called_with(getdefaulttimeout())
+
+    def test_pool_read_error(self):
+        """Connection is closed if the response is not read."""
+        pool = httpclient.HTTPConnectionPool(size=1)
+        client = httpclient.HTTPClient("http://localhost/", pool=pool)
+        self.mock_response.read.side_effect = TimeoutError()
+        self.assertRaises(TimeoutError, lambda: client.get("a"))
+        self.mock_c.close.assert_called_once_with()
+        assert 1 == pool.get_pool("http", "localhost").count
+
+    @patch.object(httpclient, "time")
+    def test_pool_idle_timeout(self, mock_time):
+        """Idle connections are closed and replaced."""
+        self.mock_c_class.side_effect = lambda netloc: Mock()
+        pool = httpclient.HTTPConnectionPool(size=1, idle_timeout=10)
+        mock_time.return_value = 100.0
+        c = pool.acquire("http", "localhost")
+        pool.get_back("http", "localhost:80", c)
+        mock_time.return_value = 105.0
+        assert c is pool.acquire("http", "localhost")
+        pool.get_back("http", "localhost", c)
+        mock_time.return_value = 120.0
+        assert c is not pool.acquire("http", "localhost")
+        c.close.assert_called_once_with()
+
     def test_ajax_get(self):
         self.client.ajax_get("auth/token")
         method, path, body, headers = self.mock_c.request.call_args[0]
@@ -87,6 +225,110 @@ class HTTPClientTestCase(unittest.TestCase):
         assert "application/json" == headers["Content-Type"]
         assert '{"a":1}' == body
 
+    def test_post_iterable(self):
+        """Iterable body is passed through to be sent chunked."""
+        chunks = (b"x" * 10 for _ in range(3))
+        self.client.post("data", content_type="text/plain", body=chunks)
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert chunks is body
+        assert "Content-Length" not in headers
+
+    def test_post_compress_body(self):
+        """Iterable body is compressed on the fly."""
+        chunks = (b"x" * 10 for _ in range(3))
+        self.client.go(
+            "data",
+            "POST",
+            content_type="text/plain",
+            body=chunks,
+            compress_body=True,
+        )
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert "gzip" == headers["Content-Encoding"]
+        assert b"x" * 30 == decompress(b"".join(body))
+
+    def test_post_compress_file(self):
+        self.client.go(
+            "data",
+            "POST",
+            content_type="text/plain",
+            body=BytesIO(b"abc"),
+            compress_body=True,
+        )
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert b"abc" == decompress(b"".join(body))
+        self.client.go("data", "PUT", body="abc", compress_body=True)
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert b"abc" == decompress(body)
+
+    def test_iterable_no_retry(self):
+        """Iterable body is not sent again on a stale connection."""
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", keep_alive=True
+        )
+        self.mock_c.request.side_effect = ConnectionResetError()
+        self.assertRaises(
+            ConnectionResetError,
+            client.go,
+            "data",
+            "PUT",
+            content_type="text/plain",
+            body=iter([b"abc"]),
+        )
+        assert 1 == self.mock_c.request.call_count
+
+    def test_headers_case_insensitive(self):
+        """Response headers are looked up regardless of case."""
+        self.headers.extend(
+            [
+                ("Content-Encoding", "gzip"),
+                ("Set-Cookie", "_x=1; path=/"),
+                ("ETag", '"ca231fbc"'),
+            ]
+        )
+        self.mock_response.read.return_value = compress(b"test")
+        self.client.get("auth/token")
+        assert b"test" == self.client.body
+        assert {"_x": "1"} == self.client.cookies
+        assert '"ca231fbc"' == self.client.etags["/api/v1/auth/token"]
+        h = self.client.headers
+        assert ["gzip"] == h["content-encoding"]
+        assert "gzip" == first_item_adapter(h)["CONTENT-ENCODING"]
+        assert 4 == len(h)
+        assert [] == h["x"]
+
+    def test_headers_dict_compatible(self):
+        """Response headers behave like a dict of lists of values."""
+        h = httpclient.HTTPHeaders(
+            [("Content-Type", "text/plain"), ("Vary", "A"), ("vary", "B")]
+        )
+        assert {"content-type": ["text/plain"], "vary": ["A", "B"]} == h
+        assert '{"content-type": ["text/plain"], "vary": ["A", "B"]}' == (
+            json.dumps(h)
+        )
+        c = h.copy()
+        assert isinstance(c, httpclient.HTTPHeaders)
+        assert h == c
+        assert ["A", "B"] == c.pop("Vary")
+        assert "vary" in h and "Vary" not in c
+        assert c.pop("vary", None) is None
+        assert ["text/plain"] == h.get("Content-Type")
+        assert h.get("x") is None
+        assert [] == h.setdefault("X-Id", [])
+        h.setdefault("x-id", []).append("1")
+        h["Date"] = ["today"]
+        h.update({"ETag": ['"x"']}, Server=["s"])
+        assert ["1"] == h["X-ID"]
+        assert ["today"] == h["date"]
+        assert ['"x"'] == h["etag"]
+        assert ["s"] == h["server"]
+        del h["DATE"]
+        assert "date" not in h
+        assert {"content-type", "vary", "x-id", "etag", "server"} == set(h)
+        assert "text/plain" == first_item_adapter(h)["Content-Type"]
+        assert [] == h["date"]
+        assert "date" not in h
+
     def test_follow(self):
         self.mock_response.status = 303
         self.headers.append(("location", "http://localhost:8080/error/401"))
@@ -125,6 +367,29 @@ class HTTPClientTestCase(unittest.TestCase):
         assert {} == self.client.json
         patcher.stop()
 
+    def test_json_hook(self):
+        """json objects are made by the json hook."""
+        self.headers.append(("content-type", "application/json"))
+        self.mock_response.read.return_value = b'{"a": {"b": 1}}'
+        self.client.get("auth/token")
+        assert 1 == self.client.json.a.b
+        self.client.json_hook = dict
+        self.client.get("auth/token")
+        assert type(self.client.json) is dict
+        self.client.json_hook = httpclient.json_record
+        self.client.get("auth/token")
+        assert 1 == self.client.json.a.b
+        assert isinstance(self.client.json, tuple)
+
+    def test_json_charset(self):
+        """json body is decoded per a declared charset."""
+        self.headers.append(
+            ("content-type", "application/json; charset=ISO-8859-1")
+        )
+        self.mock_response.read.return_value = '["\xe9"]'.encode("latin-1")
+        self.client.get("auth/token")
+        assert ["\xe9"] == self.client.json
+
     def test_gzip(self):
         """Ensure gzip decompression."""
         self.headers.append(("content-encoding", "gzip"))
@@ -132,6 +397,169 @@ class HTTPClientTestCase(unittest.TestCase):
         self.client.get("auth/token")
         assert "test" == self.client.content
 
+    def test_deflate(self):
+        """Ensure deflate decompression, zlib wrapped or raw."""
+        self.headers.append(("content-encoding", "deflate"))
+        self.mock_response.read.return_value = zlib.compress(b"test")
+        self.client.get("auth/token")
+        assert "test" == self.client.content
+        c = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.mock_response.read.return_value = c.compress(b"raw") + c.flush()
+        self.client.get("auth/token")
+        assert "raw" == self.client.content
+
+    def test_unknown_encoding(self):
+        """Unknown content encoding is left as is."""
+        self.headers.append(("content-encoding", "br"))
+        self.mock_response.read.return_value = b"test"
+        self.client.get("auth/token")
+        assert b"test" == self.client.body
+
+    def test_max_decoded_size(self):
+        """Decoding is aborted if content exceeds the limit."""
+        client = httpclient.HTTPClient(
+            "http://localhost/", max_decoded_size=10
+        )
+        self.headers.append(("content-encoding", "gzip"))
+        self.mock_response.read.return_value = compress(b"x" * 10)
+        client.get("a")
+        assert b"x" * 10 == client.body
+        self.mock_response.read.return_value = compress(b"x" * 11)
+        self.assertRaises(ValueError, lambda: client.get("a"))
+        data = compress(b"x" * 1000)
+        self.mock_response.read.side_effect = [data, b""]
+        client.get("a", stream=True)
+        self.assertRaises(ValueError, lambda: list(client.iter_body()))
+
+    def test_stream(self):
+        """Response body is read in chunks."""
+        self.mock_response.read.side_effect = [b"ab", b"c", b""]
+        self.client.get("auth/token", stream=True)
+        assert self.client.body is None
+        assert not self.mock_c.close.called
+        assert [b"ab", b"c"] == list(self.client.iter_body(2))
+        self.mock_response.read.assert_called_with(2)
+        self.mock_c.close.assert_called_once_with()
+
+    def test_stream_gzip(self):
+        """Gzip content is decoded incrementally."""
+        self.headers.append(("content-encoding", "gzip"))
+        data = compress(b"test" * 1000)
+        chunks = [data[i:][:10] for i in range(0, len(data), 10)]
+        self.mock_response.read.side_effect = chunks + [b""]
+        self.client.ajax_get("auth/token", stream=True)
+        f = BytesIO()
+        assert 4000 == self.client.write_body(f, 10)
+        assert b"test" * 1000 == f.getvalue()
+
+    def test_stream_keep_alive(self):
+        """Connection is closed if the body is not read to the end."""
+        pool = httpclient.HTTPConnectionPool(size=1)
+        client = httpclient.HTTPClient("http://localhost/", pool=pool)
+        self.mock_response.read.side_effect = [b"a", b"b", b""]
+        client.get("a", stream=True)
+        assert 0 == pool.get_pool("http", "localhost").count
+        assert [b"a", b"b"] == list(client.iter_body())
+        assert not self.mock_c.close.called
+        assert 1 == pool.get_pool("http", "localhost").count
+        self.mock_response.read.side_effect = [b"a", b"b", b""]
+        client.get("a", stream=True)
+        body = client.iter_body()
+        assert b"a" == next(body)
+        body.close()
+        self.mock_c.close.assert_called_once_with()
+        assert 1 == pool.get_pool("http", "localhost").count
+        client.get("a", stream=True)
+        client.get("a")
+        assert 2 == self.mock_c.close.call_count
+        assert 1 == pool.get_pool("http", "localhost").count
+
+    def test_stream_close(self):
+        """Stream not read is closed and gives the pool slot back."""
+        pool = httpclient.HTTPConnectionPool(size=1)
+        client = httpclient.HTTPClient("http://localhost/", pool=pool)
+        self.mock_response.read.side_effect = [b"a", b"b", b""]
+        client.get("a", stream=True)
+        assert 0 == pool.get_pool("http", "localhost").count
+        client.close_stream()
+        self.mock_c.close.assert_called_once_with()
+        assert 1 == pool.get_pool("http", "localhost").count
+        client.close_stream()
+        assert 1 == self.mock_c.close.call_count
+        self.mock_response.read.side_effect = [b"a", b"b", b""]
+        client.get("a", stream=True)
+        body = client.iter_body()
+        assert b"a" == next(body)
+        client.close_stream()
+        body.close()
+        assert 2 == self.mock_c.close.call_count
+        assert 1 == pool.get_pool("http", "localhost").count
+
+    def test_stream_replaced(self):
+        """Closing a body of a replaced stream keeps the current one."""
+        a, b = Mock(), Mock()
+        for r in (a, b):
+            r.getheaders.return_value = []
+            r.read.side_effect = [b"1", b"2", b""]
+        self.mock_c.getresponse.side_effect = [a, b]
+        client = httpclient.HTTPClient("http://localhost/", keep_alive=True)
+        client.get("a", stream=True)
+        body_a = client.iter_body()
+        assert b"1" == next(body_a)
+        client.get("b", stream=True)
+        self.mock_c.close.assert_called_once_with()
+        body_b = client.iter_body()
+        body_a.close()
+        assert 1 == self.mock_c.close.call_count
+        assert [b"1", b"2"] == list(body_b)
+        assert 1 == self.mock_c.close.call_count
+
+    def test_go_many(self):
+        """Requests run concurrently, results are in order."""
+        self.mock_response.status = 200
+        self.mock_c.getresponse.side_effect = [
+            self.mock_response,
+            KeyError(),
+        ]
+        self.client.cookies["_x"] = "1"
+        results = self.client.go_many(
+            [{"path": "a"}, {"path": "b", "method": "POST"}],
+            max_workers=1,
+            timeout=5,
+        )
+        assert 2 == len(results)
+        assert 200 == results[0].status_code
+        assert results[0].error is None
+        assert results[0].elapsed >= 0
+        assert isinstance(results[1].error, KeyError)
+        assert 5 == results[1].timeout
+        assert self.client is not results[0]
+        assert self.client.cookies == results[0].cookies
+        assert self.client.cookies is not results[0].cookies
+        self.mock_c.sock.settimeout.assert_called_with(5)
+        assert 0 == self.client.status_code
+
+    def test_go_many_deadline(self):
+        """Requests not completed within deadline fail."""
+        release = Event()
+
+        def getresponse():
+            release.wait()
+            return self.mock_response
+
+        self.mock_c.getresponse.side_effect = getresponse
+        self.mock_response.status = 200
+        finished = Event()
+        self.client.timed = True
+        self.client.on_timing = lambda client, timing: finished.set()
+        results = self.client.go_many([{"path": "a"}], deadline=0.01)
+        release.set()
+        assert isinstance(results[0].error, TimeoutError)
+        assert results[0].elapsed is None
+        assert finished.wait(5)
+        assert 0 == results[0].status_code
+        assert results[0].body is None
+
     def test_etag(self):
         """ETag processing."""
         self.headers.append(("etag", '"ca231fbc"'))
@@ -142,3 +570,576 @@ class HTTPClientTestCase(unittest.TestCase):
         self.client.get("auth/token")
         method, path, body, headers = self.mock_c.request.call_args[0]
         assert '"ca231fbc"' == headers["If-None-Match"]
+
+    def test_cache_fresh(self):
+        """Fresh cached response is served without a request."""
+        self.mock_response.status = 200
+        self.mock_response.read.return_value = b"hello"
+        self.headers.append(("Cache-Control", "max-age=60"))
+        self.client.cache = httpclient.ResponseCache()
+        assert 200 == self.client.get("data")
+        self.mock_response.read.return_value = b""
+        self.mock_c.request.reset_mock()
+        assert 200 == self.client.get("data")
+        assert not self.mock_c.request.called
+        assert b"hello" == self.client.body
+        assert "hello" == self.client.content
+
+    def test_cache_not_modified(self):
+        """Stale response is revalidated and replayed on 304."""
+        self.mock_response.status = 200
+        self.mock_response.read.return_value = compress(b"hello")
+        self.headers.extend(
+            [
+                ("content-encoding", "gzip"),
+                ("last-modified", "Sat, 12 Oct 2013 18:29:13 GMT"),
+            ]
+        )
+        self.client.cache = httpclient.ResponseCache()
+        self.client.get("data")
+        self.mock_response.status = 304
+        self.mock_response.read.return_value = b""
+        del self.headers[1:]
+        assert 200 == self.client.get("data")
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert self.headers[0][1] == headers["If-Modified-Since"]
+        assert b"hello" == self.client.body
+
+    def test_cache_evicted(self):
+        """No ETag validator is sent without a cached response."""
+        self.mock_response.status = 200
+        self.headers.append(("ETag", '"a"'))
+        self.client.cache = httpclient.ResponseCache(maxsize=1)
+        self.client.get("a")
+        self.client.get("b")
+        self.client.get("a")
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert "If-None-Match" not in headers
+        assert '"a"' == self.client.etags["/api/v1/a"]
+
+    def test_cache_key_changed(self):
+        """No ETag validator is sent if a cookie changes cache key."""
+        self.mock_response.status = 200
+        self.headers.append(("ETag", '"a"'))
+        self.client.cache = httpclient.ResponseCache()
+        self.client.get("a")
+        self.client.get("a")
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert '"a"' == headers["If-None-Match"]
+        self.client.cookies["s"] = "1"
+        self.client.get("a")
+        method, path, body, headers = self.mock_c.request.call_args[0]
+        assert "If-None-Match" not in headers
+
+    def test_cache_no_store(self):
+        self.mock_response.status = 200
+        self.headers.append(("Cache-Control", "no-store, max-age=60"))
+        self.client.cache = httpclient.ResponseCache()
+        self.client.get("data")
+        assert not self.client.cache.items
+
+    def test_cache_vary(self):
+        """Cached response is used only if Vary headers match."""
+        self.mock_response.status = 200
+        self.mock_response.read.return_value = b"a"
+        self.headers.extend(
+            [("Cache-Control", "max-age=60"), ("Vary", "Accept")]
+        )
+        self.client.cache = httpclient.ResponseCache()
+        self.client.get("data", headers={"Accept": "text/plain"})
+        self.client.get("data", headers={"Accept": "text/plain"})
+        assert 1 == self.mock_c.request.call_count
+        self.client.get("data", headers={"Accept": "text/html"})
+        assert 2 == self.mock_c.request.call_count
+
+    def test_cache_credentials(self):
+        """Responses are cached per Authorization and Cookie."""
+        self.mock_response.status = 200
+        self.headers.append(("Cache-Control", "max-age=60"))
+        cache = httpclient.ResponseCache()
+        self.client.cache = cache
+        self.client.get("data", headers={"Authorization": "Basic a"})
+        other = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", cache=cache
+        )
+        other.get("data", headers={"Authorization": "Basic b"})
+        other.cookies["s"] = "1"
+        other.get("data")
+        assert 3 == self.mock_c.request.call_count
+        assert 3 == len(cache.items)
+
+    def test_timing_off(self):
+        self.client.get("auth/token")
+        assert self.client.timing is None
+
+    def test_timing(self):
+        """Phases are recorded and reported to the callback."""
+        calls = []
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/",
+            on_timing=lambda c, t: calls.append((c, t)),
+        )
+        client.get("auth/token")
+        t = client.timing
+        assert [(client, t)] == calls
+        assert self.mock_c.connect.called
+        assert 0.0 < t.connect <= t.sent <= t.first_byte <= t.complete
+
+    def test_timing_keep_alive(self):
+        """Reused connection has no connect phase."""
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", keep_alive=True, timing=True
+        )
+        client.get("auth/token")
+        assert not self.mock_c.connect.called
+        assert 0.0 == client.timing.connect
+        assert client.timing.complete is not None
+
+    def test_timing_stream(self):
+        """Stream timing completes once the body is read."""
+        self.mock_response.read.side_effect = [b"abc", b""]
+        client = httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/", timing=True
+        )
+        client.go("data", stream=True)
+        assert client.timing.complete is None
+        assert b"abc" == b"".join(client.iter_body())
+        assert client.timing.complete is not None
+
+    def retry_client(self, statuses, **kwargs):
+        responses = []
+        for status in statuses:
+            r = Mock()
+            r.status = status
+            r.getheaders.return_value = list(self.headers)
+            r.read.return_value = b""
+            responses.append(r)
+        self.mock_c.getresponse.side_effect = responses
+        return httpclient.HTTPClient(
+            "http://localhost:8080/api/v1/",
+            retry_policy=httpclient.RetryPolicy(
+                timeout=0.05, start=0.001, end=0.01, **kwargs
+            ),
+        )
+
+    def test_retry(self):
+        """Transient statuses are retried."""
+        client = self.retry_client([503, 502, 200])
+        assert 200 == client.get("data")
+        assert 2 == client.retries
+        assert 3 == self.mock_c.request.call_count
+
+    def test_retry_not_idempotent(self):
+        client = self.retry_client([503, 200])
+        assert 503 == client.post("data", params={"a": "1"})
+        assert 0 == client.retries
+
+    def test_retry_error(self):
+        """Connection errors are retried until the deadline."""
+        self.mock_c.request.side_effect = ConnectionResetError()
+        client = self.retry_client([])
+        self.assertRaises(ConnectionResetError, client.get, "data")
+        assert client.retries > 0
+
+    def test_retry_after_deadline(self):
+        """Gives up if Retry-After exceeds the deadline."""
+        self.headers.append(("retry-after", "120"))
+        client = self.retry_client([503, 200])
+        assert 503 == client.get("data")
+        assert 0 == client.retries
+
+    def test_retry_after_delay(self):
+        """Retry-After replaces the backoff delay, not adds to it."""
+        self.headers.append(("retry-after", "1"))
+        client = self.retry_client([503, 503, 200])
+        client.retry_policy = httpclient.RetryPolicy(
+            timeout=10.0, start=0.25, end=2.0
+        )
+        sleeps = []
+        with (
+            patch.object(httpclient, "sleep", sleeps.append),
+            patch("wheezy.core.retry.sleep", sleeps.append),
+        ):
+            assert 200 == client.get("data")
+        assert 2 == client.retries
+        # 1st wait: Retry-After 1s, 2nd wait: Retry-After 1s (backoff 0.5s)
+        assert [0.75, 0.25, 0.5, 0.5] == sleeps
+        assert 2.0 == sum(sleeps)
+
+    def test_retry_short_timeout(self):
+        """Backoff is limited by the deadline, the last attempt does
+        not wait.
+        """
+        self.headers.append(("retry-after", "1"))
+        client = self.retry_client([503] * 10)
+        client.retry_policy = httpclient.RetryPolicy(timeout=1.0)
+        clock = [0.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            clock[0] += delay
+
+        with (
+            patch.object(httpclient, "sleep", sleep),
+            patch.object(httpclient, "time", lambda: clock[0]),
+            patch("wheezy.core.retry.sleep", sleep),
+            patch("wheezy.core.retry.time", lambda: clock[0]),
+        ):
+            assert 503 == client.get("data")
+        assert 1 == client.retries
+        assert [0.9, 0.1] == [round(s, 6) for s in sleeps]
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def test_lru(self):
+        cache = httpclient.ResponseCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert 1 == cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert 1 == cache.get("a")
+        assert 3 == cache.get("c")
+
+    def test_disk(self):
+        """Entries are stored as JSON metadata and raw body."""
+        entry = httpclient.CachedResponse.create(
+            200,
+            [("ETag", '"x"'), ("Set-Cookie", "a=1"), ("Vary", "Accept")],
+            b"hello",
+            {"accept": "text/plain"},
+        )
+        assert [("ETag", '"x"'), ("Vary", "Accept")] == entry.headers
+        with TemporaryDirectory() as path:
+            httpclient.ResponseCache(path=path).set("k", entry)
+            assert 2 == len(os.listdir(path))
+            name = httpclient.ResponseCache(path=path).filename("k")
+            with open(name + ".json") as f:
+                assert "k" == json.load(f)["key"]
+            cache = httpclient.ResponseCache(path=path)
+            assert cache.get("x") is None
+            entry = cache.get("k")
+            assert b"hello" == entry.body
+            assert '"x"' == entry.etag
+            assert entry.matches({"accept": "text/plain"})
+            assert not entry.matches({})
+
+    def test_disk_size(self):
+        """Least recently used files are removed over the disk limit."""
+        with TemporaryDirectory() as path:
+            cache = httpclient.ResponseCache(path=path, max_disk_size=500)
+            for key in ("a", "b", "c"):
+                entry = httpclient.CachedResponse.create(
+                    200, [("ETag", key)], b"x" * 100, {}
+                )
+                cache.set(key, entry)
+            assert 4 == len(os.listdir(path))
+            assert cache.disk_size <= 500
+            cache = httpclient.ResponseCache(maxsize=1, path=path)
+            assert cache.get("a") is None
+            assert b"x" * 100 == cache.get("c").body
+
+    def test_not_cacheable(self):
+        create = httpclient.CachedResponse.create
+        assert create(200, [], b"", {}) is None
+        for value in ("private, max-age=60", "no-store"):
+            assert create(200, [("Cache-Control", value)], b"", {}) is None
+        assert create(200, [("ETag", "x"), ("Vary", "*")], b"", {}) is None
+
+
+class ResolverTestCase(unittest.TestCase):
+    def setUp(self):
+        self.patcher = patch.object(httpclient, "getaddrinfo")
+        self.mock_getaddrinfo = self.patcher.start()
+        self.addresses = [
+            (AF_INET, SOCK_STREAM, 6, "", ("127.0.0.1", 80)),
+            (AF_INET, SOCK_STREAM, 6, "", ("127.0.0.2", 80)),
+        ]
+        self.mock_getaddrinfo.return_value = self.addresses
+        self.resolver = httpclient.Resolver()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_cache(self):
+        """Addresses are cached and rotated round robin."""
+        r = self.resolver.resolve("localhost", 80)
+        assert self.addresses == r
+        r = self.resolver.resolve("localhost", 80)
+        assert self.addresses[::-1] == r
+        assert self.addresses == self.resolver.resolve("localhost", 80)
+        assert 1 == self.mock_getaddrinfo.call_count
+
+    def test_ttl(self):
+        self.resolver.ttl = 0
+        self.resolver.resolve("localhost", 80)
+        self.resolver.resolve("localhost", 80)
+        assert 2 == self.mock_getaddrinfo.call_count
+
+    def test_negative(self):
+        """Resolution failure is cached."""
+        self.mock_getaddrinfo.side_effect = gaierror(-2, "not known")
+        for _ in range(2):
+            self.assertRaises(gaierror, self.resolver.resolve, "x", 80)
+        assert 1 == self.mock_getaddrinfo.call_count
+        self.resolver.clear()
+        self.assertRaises(gaierror, self.resolver.resolve, "x", 80)
+        assert 2 == self.mock_getaddrinfo.call_count
+
+    def test_create_connection(self):
+        """Connects to the next address if one fails."""
+        server = create_server(("127.0.0.1", 0))
+        port = server.getsockname()[1]
+        closed = create_server(("127.0.0.1", 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        self.mock_getaddrinfo.return_value = [
+            (AF_INET, SOCK_STREAM, 6, "", ("127.0.0.1", closed_port)),
+            (AF_INET, SOCK_STREAM, 6, "", ("127.0.0.1", port)),
+        ]
+        try:
+            sock = self.resolver.create_connection(("localhost", port), 1.0)
+            assert port == sock.getpeername()[1]
+            sock.close()
+        finally:
+            server.close()
+
+    def test_client(self):
+        """Client connections resolve host names via resolver."""
+        with patch.object(httpclient, "HTTPConnection") as mock_c_class:
+            client = httpclient.HTTPClient(
+                "http://localhost:8080/", resolver=self.resolver
+            )
+            pool = httpclient.HTTPConnectionPool(resolver=self.resolver)
+            pool.acquire("http", "localhost:8080")
+        c = client.connection
+        assert c is mock_c_class.return_value
+        assert self.resolver.create_connection == c._create_connection
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # noqa: N802
+        status = self.path == "/fail" and 500 or 200
+        self.send_response(status)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class LoadTestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_rate(self):
+        """Requests are not sent above the target rate."""
+        client = httpclient.HTTPClient(
+            self.url, pool=httpclient.HTTPConnectionPool()
+        )
+        stats = httpclient.LoadTest(
+            client, ["ok", "fail"], concurrency=2, rate=100, duration=0.2
+        ).run()
+        # no request is scheduled past the duration
+        assert 1 <= stats.requests <= 100 * 0.2 + 2
+        assert stats.requests == sum(stats.statuses.values())
+        assert stats.statuses[500] == stats.failures
+        assert 0 < stats.latency.percentile(50) <= stats.latency.max
+
+    def test_main(self):
+        out = StringIO()
+        with redirect_stdout(out):
+            rc = httpclient.main([self.url, "-c", "2", "-d", "0.1"])
+        assert 0 == rc
+        report = out.getvalue()
+        assert "failures: 0 (0.00%)" in report
+        assert "status 200" in report
+        assert "99.9%" in report
+
+
+class AsyncHTTPClientTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.connections = 0
+        self.delay = 0
+        self.requests = []
+        self.responses = []
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.pool = httpclient.AsyncHTTPConnectionPool(size=2)
+        self.client = httpclient.AsyncHTTPClient(
+            "http://127.0.0.1:%d/api/" % port, pool=self.pool
+        )
+
+    async def asyncTearDown(self):
+        for host in self.pool.hosts.values():
+            for reader, writer, last_used in host[1]:
+                writer.close()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            headers = {}
+            while True:
+                h = await reader.readline()
+                if h == b"\r\n":
+                    break
+                name, value = h.decode().split(":", 1)
+                headers[name.lower()] = value.strip()
+            body = await reader.readexactly(
+                int(headers.get("content-length", 0))
+            )
+            self.requests.append((line.decode().split()[:2], headers, body))
+            await asyncio.sleep(self.delay)
+            writer.write(self.responses.pop(0))
+            await writer.drain()
+        writer.close()
+
+    def respond(self, status="200 OK", headers=(), body=b""):
+        lines = ["HTTP/1.1 " + status]
+        lines.extend(headers)
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        self.responses.append(
+            ("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b"")
+        )
+
+    async def test_get(self):
+        """Connection is kept alive."""
+        self.respond(body=b"hello")
+        self.respond(body=b"world")
+        assert 200 == await self.client.get("a", params={"x": ["1"]})
+        assert b"hello" == self.client.body
+        assert 200 == await self.client.get("b")
+        assert "world" == self.client.content
+        assert 1 == self.connections
+        (method, path), headers, body = self.requests[0]
+        assert ["GET", "/api/a?x=1"] == [method, path]
+        assert "gzip" == headers["accept-encoding"]
+        assert "keep-alive" == headers["connection"]
+
+    def test_make_request_host(self):
+        """Host supplied by caller replaces the default one."""
+        request = self.client.make_request(
+            "GET", "/a", "", {"host": "example.com"}
+        )
+        assert 1 == request.lower().count(b"host:")
+        assert b"host: example.com\r\n" in request
+
+    async def test_injection(self):
+        """Control characters in request line or headers are rejected."""
+        self.assertRaises(
+            InvalidURL,
+            self.client.make_request,
+            "GET",
+            "/a HTTP/1.1\r\nX-A: 1",
+            "",
+            {},
+        )
+        self.assertRaises(
+            ValueError, self.client.make_request, "GE T", "/a", "", {}
+        )
+        with self.assertRaises(ValueError):
+            await self.client.get("a", headers={"X-A": "1\r\nX-B: 2"})
+        with self.assertRaises(ValueError):
+            await self.client.get("a", headers={"X:A": "1"})
+        assert 0 == self.connections
+
+    async def test_post_json(self):
+        """Body is sent and json response decoded."""
+        self.respond(
+            headers=["Content-Type: application/json"], body=b'{"a": 1}'
+        )
+        await self.client.post("a", params={"x": "1"})
+        assert 1 == self.client.json.a
+        assert (["POST", "/api/a"], b"x=1") == (
+            self.requests[0][0],
+            self.requests[0][2],
+        )
+
+    async def test_chunked_gzip(self):
+        """Chunked and gzipped response is decoded."""
+        data = compress(b"test")
+        self.respond(
+            headers=[
+                "Transfer-Encoding: chunked",
+                "Content-Encoding: gzip",
+            ],
+            body=None,
+        )
+        self.responses[-1] += b"%x\r\n%s\r\n0\r\n\r\n" % (len(data), data)
+        await self.client.get("a")
+        assert "test" == self.client.content
+
+    async def test_cookies_etag_follow(self):
+        """Cookies, etags and redirects are handled."""
+        self.respond(
+            "302 Found",
+            ["Set-Cookie: _x=1; path=/", "Location: /api/b", 'ETag: "e"'],
+        )
+        self.respond("304 Not Modified", body=None)
+        await self.client.get("a")
+        assert {"_x": "1"} == self.client.cookies
+        assert 304 == await self.client.follow()
+        method, headers, body = self.requests[1]
+        assert ["GET", "/api/b"] == method
+        assert "_x=1" == headers["cookie"]
+        assert '"e"' == self.client.etags["/api/a"]
+
+    async def test_connection_close(self):
+        """Connection is not reused if server closes it."""
+        self.respond(headers=["Connection: close"], body=b"")
+        self.respond(body=b"")
+        await self.client.head("a")
+        await self.client.get("a")
+        assert 2 == self.connections
+
+    async def test_go_many(self):
+        """Requests run concurrently, results are in order."""
+        self.respond(body=b"a")
+        self.respond(body=b"b")
+        results = await self.client.go_many(
+            [{"path": "a"}, {"path": "b"}], max_workers=2
+        )
+        assert sorted([b"a", b"b"]) == sorted(r.body for r in results)
+        assert [None, None] == [r.error for r in results]
+        assert [] == await self.client.go_many([])
+
+    async def test_go_many_deadline(self):
+        """Requests not completed within deadline fail."""
+        self.delay = 0.05
+        self.respond(body=b"")
+        results = await self.client.go_many([{"path": "a"}], deadline=0.01)
+        assert isinstance(results[0].error, TimeoutError)
+        assert results[0].elapsed is None
+
+    async def test_stale_connection(self):
+        """Idempotent request is retried if connection was closed."""
+        self.respond(body=b"")
+        await self.client.get("a")
+        idle = list(self.pool.hosts.values())[0][1]
+        reader, writer, last_used = idle[0]
+        stale = asyncio.StreamReader()
+        asyncio.get_running_loop().call_soon(stale.feed_eof)
+        idle[0] = (stale, writer, last_used)
+        self.respond(body=b"")
+        self.respond(body=b"ok")
+        assert 200 == await self.client.get("a")
+        assert b"ok" == self.client.body
+        assert 2 == self.connections
+        assert writer.is_closing()